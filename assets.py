@@ -0,0 +1,110 @@
+"""Cache of remote user images: profile backgrounds and avatars.
+
+Downloads are content-addressed: the URL maps to the SHA-1 of its content,
+and the content and everything derived from it (the 48x48 avatar, the
+background pre-tiled to canvas size) are keyed by that digest. Users share
+a lot of images, and a cached derivative means nothing is downloaded or
+resized at all.
+"""
+
+from hashlib import sha1
+import logging
+
+from google.appengine.api import images, urlfetch
+
+from cache import LRUCache, TwoTierCache
+from compositor import COMPOSITOR
+import metrics
+
+
+# URLs are re-checked daily, content doesn't change under its digest
+URL_TTL = 24 * 60 * 60
+CONTENT_TTL = 7 * 24 * 60 * 60
+
+# Larger images aren't cached (memcache values are limited to 1MB anyway)
+MAX_BYTES = 900 * 1024
+
+# Pre-tiled backgrounds are made this much taller at a time, so a handful
+# of them cover all canvas heights
+TILE_HEIGHT_STEP = 120
+
+AVATAR_SIZE = 48
+
+DIGESTS = TwoTierCache("asset-url:", LRUCache(max_items=5000), time=URL_TTL)
+CONTENT = TwoTierCache("asset:", LRUCache(max_items=500, max_bytes=8 * 2**20),
+                       time=CONTENT_TTL)
+
+
+class Asset(object):
+    """A remote image. Starts downloading right away unless the URL has been
+    seen before; then the content, if it's needed at all, comes from the
+    cache."""
+
+    def __init__(self, url, kind="image"):
+        self.url, self.kind = url, kind
+        self.digest = DIGESTS.get(url)
+        self._rpc = self._content = None
+        if self.digest is None:
+            self._fetch()
+
+    def _fetch(self):
+        logging.debug("Loading %s from %r" % (self.kind, self.url))
+        metrics.count("asset_fetches")
+        self._rpc = urlfetch.create_rpc()
+        urlfetch.make_fetch_call(self._rpc, self.url)
+
+    def content(self):
+        """The image data, or None if the download failed."""
+        if self._content is None and self._rpc is None and self.digest:
+            self._content = CONTENT.get(self.digest)
+            if self._content is None:
+                # Evicted, need to download after all
+                self._fetch()
+        if self._content is None and self._rpc:
+            rs, self._rpc = self._rpc.get_result(), None
+            if rs.status_code != 200:
+                logging.warning("%s download failed %d: %r"
+                                % (self.kind.capitalize(), rs.status_code,
+                                   rs.content))
+                return None
+            self._content = rs.content
+            self.digest = sha1(rs.content).hexdigest()
+            DIGESTS.set(self.url, self.digest)
+            if len(rs.content) <= MAX_BYTES:
+                CONTENT.set(self.digest, rs.content)
+        return self._content
+
+    def _derived(self, name, make):
+        if self.digest:
+            derived = CONTENT.get((name, self.digest))
+            if derived is not None:
+                return derived
+        content = self.content()
+        if content is None:
+            return None
+        derived = make(content)
+        if len(derived) <= MAX_BYTES:
+            CONTENT.set((name, self.digest), derived)
+        return derived
+
+    def avatar(self, size=AVATAR_SIZE):
+        """The image resized to `size`x`size`."""
+        def _resize(content):
+            img = images.Image(content)
+            if img.width == img.height == size:
+                return content
+            return images.resize(content, size, size)
+        return self._derived("avatar-%d" % size, _resize)
+
+    def tiled(self, width, height):
+        """The image tiled over a canvas of at least `width`x`height`, to be
+        laid at the top left."""
+        height = -(-height / TILE_HEIGHT_STEP) * TILE_HEIGHT_STEP
+
+        def _tile(content):
+            img = images.Image(content)
+            return COMPOSITOR.composite([(content, x, y, 1., images.TOP_LEFT)
+                                         for x in range(0, width, img.width)
+                                         for y in range(0, height, img.height)],
+                                        width, height, 0)
+        return self._derived("tiled-%dx%d" % (width, height), _tile)
@@ -0,0 +1,48 @@
+"""Error images, served in place of tweets that can't be rendered.
+
+A banner is its message in red on white, like error.png: what the Chart
+API used to be asked for on every error. Each is rendered once with the
+text backend (see `typeset`) and then served from the instance, so errors
+make no remote calls. If one can't be rendered, error.png stands in for
+it, for `RETRY` seconds before the next try.
+"""
+
+import logging
+import time
+
+import formats
+import typeset
+
+
+MESSAGES = {
+    404: u"Tweetpong: No such tweet, or it isn't public",
+    500: u"Tweetpong: Failed to process tweet :(",
+    502: u"Tweetpong: Twitter API error, try again in a bit",
+}
+
+FALLBACK = open("error.png", "rb").read()
+
+RETRY = 60
+
+# Banners by status, with the time they're good until
+_banners = {}
+
+
+def get(status):
+    """The PNG banner for error `status`."""
+    status = status if status in MESSAGES else 500
+    banner, until = _banners.get(status, (None, 0))
+    if banner is None or until < time.time():
+        try:
+            banner = formats.encode(
+                typeset.text_img(MESSAGES[status], "a00000", 13, "ffffff").img)
+            until = float("inf")
+        except Exception, e:
+            logging.warning("Rendering the %d banner failed: %s" % (status, e))
+            banner, until = FALLBACK, time.time() + RETRY
+        _banners[status] = banner, until
+    return banner
+
+def warm():
+    for status in MESSAGES:
+        get(status)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""Benchmark: rendering a recorded corpus of tweets, offline.
+
+Runs `_gen_shot` on the stand-ins in bench/standins instead of App Engine.
+Twitter responses are replayed from bench/fixtures/corpus.json: short,
+URL-heavy, CJK, emoji, many-mention and maximum-length tweets. Chart API
+text images are replayed from bench/fixtures/charts.json, recorded with
+--record; texts missing from it are synthesized at the width the glyph
+model predicts, skewed like in split.py, and counted as such.
+
+Each case is rendered cold (all caches flushed), warm, and evicted (all
+caches flushed but the stored line layout, like a re-render after the
+image and the text fragments were evicted). Each run reports wall time,
+time per stage, remote calls by service and composite passes. The
+results are saved as JSON; --compare reports regressions against an
+earlier run and exits with 1 if there are any:
+
+    python bench/render.py [--repeat 5] [--out FILE] [--compare FILE]
+    python bench/render.py --record
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import time
+import urllib2
+import urlparse
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCH, "standins"), os.path.join(BENCH, "..")]
+os.environ.setdefault('SERVER_NAME', "localhost")
+os.environ.setdefault('INSTANCE_ID', "bench")
+# Bundled images are read relative to the app directory
+os.chdir(os.path.join(BENCH, ".."))
+
+from google.appengine.api import images, memcache, urlfetch
+from google.appengine.ext import db
+
+import assets
+import charts
+import chrome
+from compositor import COMPOSITOR
+import glyphs
+import layouts
+import main
+import metrics
+import shots
+import typeset
+
+
+CORPUS = os.path.join(BENCH, "fixtures", "corpus.json")
+CHARTS = os.path.join(BENCH, "fixtures", "charts.json")
+RESULTS = os.path.join(BENCH, "results")
+
+CHART_MAX_WIDTH = 1000
+SKEW = 1.04
+
+# Slower by more than this (and by more than a millisecond) is a regression
+WALL_TOLERANCE = .1
+
+
+class Replay(object):
+    """Answers fetches from the corpus and the recorded chart responses."""
+
+    def __init__(self, corpus, recorded, record=False):
+        self.tweets = dict((case['tweet']['id'], case['tweet'])
+                           for case in corpus['cases'])
+        self.images = corpus['images']
+        self.recorded, self.record = recorded, record
+        self.synthesized = set()
+
+    def __call__(self, url, method, headers, payload):
+        parsed = urlparse.urlparse(url)
+        query = urlparse.parse_qs(parsed.query)
+        if parsed.netloc == "api.twitter.com":
+            return self._twitter(parsed.path, query)
+        if parsed.netloc == "chart.apis.google.com":
+            return self._chart(url, query)
+        size = self.images.get(url)
+        if size:
+            return urlfetch.Response(200, images.blank(*size))
+        return None
+
+    def _twitter(self, path, query):
+        def _found(content):
+            return urlfetch.Response(200, json.dumps(content), {
+                'Content-Type': "application/json; charset=utf-8",
+                'x-rate-limit-remaining': "899",
+                'x-rate-limit-reset': str(int(time.time()) + 900)})
+
+        if path.endswith("/statuses/lookup.json"):
+            ids = query['id'][0].split(",")
+            return _found({'id': dict((i, self.tweets.get(int(i)))
+                                      for i in ids)})
+        tweet = self.tweets.get(int(path.rsplit("/", 1)[-1].split(".")[0]))
+        if tweet is None:
+            return urlfetch.Response(404, '{"errors": [{"code": 144}]}', {
+                'Content-Type': "application/json; charset=utf-8"})
+        return _found(tweet)
+
+    def _chart(self, url, query):
+        recorded = self.recorded.get(url)
+        if recorded is None and self.record:
+            try:
+                rs = urllib2.urlopen(url, timeout=10)
+                recorded = [rs.getcode(), base64.b64encode(rs.read())]
+            except urllib2.HTTPError, e:
+                recorded = [e.code, base64.b64encode(e.read())]
+            self.recorded[url] = recorded
+        if recorded is not None:
+            return urlfetch.Response(recorded[0], base64.b64decode(recorded[1]))
+
+        self.synthesized.add(url)
+        _color, size, _align, _outline, _style, text = \
+            query['chld'][0].decode('utf-8').split(u"|", 5)
+        width = int(glyphs.MODEL.predict(text, int(size)) * SKEW)
+        if width > CHART_MAX_WIDTH:
+            return urlfetch.Response(400, "Bad Request")
+        return urlfetch.Response(200, images.blank(max(width, 1), int(size) + 8))
+
+
+def flush(keep_layout_of=None):
+    """Empties every cache: memcache, the datastore and the in-process
+    ones. The stored layout of tweet `keep_layout_of` is kept."""
+    kept = keep_layout_of and memcache.get(layouts.KEY % keep_layout_of)
+    memcache.flush_all()
+    if kept:
+        memcache.set(layouts.KEY % keep_layout_of, kept)
+    db._entities.clear()
+    for cache in (charts.FRAGMENTS.local, assets.DIGESTS.local,
+                  assets.CONTENT.local, shots.LOCAL):
+        cache.clear()
+    for backend in typeset.chain():
+        if hasattr(backend, "fragments"):
+            backend.fragments.clear()
+    chrome.CHROME._cards.clear()
+
+
+def render(tweet_id):
+    """Renders `tweet_id` once, returns its measurements."""
+    del urlfetch.CALLS[:]
+    images.COMPOSITES[0] = 0
+    metrics.start()
+    started = time.time()
+    img = main._gen_shot(tweet_id)
+    wall = (time.time() - started) * 1000
+    trace = metrics.finish()
+
+    calls = {}
+    for url in urlfetch.CALLS:
+        host = urlparse.urlparse(url).netloc
+        service = {"api.twitter.com": "twitter",
+                   "chart.apis.google.com": "chart"}.get(host, "assets")
+        calls[service] = calls.get(service, 0) + 1
+    return {
+        'wall_ms': wall,
+        'stages_ms': dict((name, ms) for name, ms in trace.spans.items()
+                          if name != 'total'),
+        'remote_calls': calls,
+        'composite_passes': trace.counters.get('composite_passes', 0),
+        'images_api_composites': images.COMPOSITES[0],
+        'bytes': len(img),
+    }
+
+
+def _median(runs):
+    """The run with the median wall time."""
+    return sorted(runs, key=lambda run: run['wall_ms'])[len(runs) / 2]
+
+
+def run(corpus, repeat):
+    results = {}
+    for case in corpus['cases']:
+        tweet_id = case['tweet']['id']
+        cold, warm, evicted = [], [], []
+        for _i in range(repeat):
+            flush()
+            cold.append(render(tweet_id))
+            warm.append(render(tweet_id))
+            flush(keep_layout_of=tweet_id)
+            evicted.append(render(tweet_id))
+        result = results[case['case']] = {
+            'cold': _median(cold), 'warm': _median(warm),
+            'evicted': _median(evicted)}
+        print "%-12s" % case['case'] + "".join(
+            "   %s %7.1fms %3d calls %2d passes" % (
+                phase, result[phase]['wall_ms'],
+                sum(result[phase]['remote_calls'].values()),
+                result[phase]['composite_passes'])
+            for phase in ('cold', 'warm', 'evicted'))
+    return results
+
+
+def compare(old, new):
+    """Prints the differences of `new` results to `old`. Returns the
+    regressions."""
+    regressions = []
+    for case, phases in sorted(new['cases'].items()):
+        for phase, result in sorted(phases.items()):
+            before = old['cases'].get(case, {}).get(phase)
+            if before is None:
+                continue
+            name = "%s/%s" % (case, phase)
+            change = result['wall_ms'] / max(before['wall_ms'], .001) - 1
+            print "%-20s %7.1fms -> %7.1fms (%+.0f%%)" % (
+                name, before['wall_ms'], result['wall_ms'], change * 100)
+            if change > WALL_TOLERANCE \
+                    and result['wall_ms'] - before['wall_ms'] > 1:
+                regressions.append("%s wall time %+.0f%%" % (name, change * 100))
+            counts = [('composite_passes', before['composite_passes'],
+                       result['composite_passes'])]
+            counts += [("%s calls" % service,
+                        before['remote_calls'].get(service, 0),
+                        result['remote_calls'].get(service, 0))
+                       for service in set(before['remote_calls'])
+                                       | set(result['remote_calls'])]
+            for what, was, now in counts:
+                if now != was:
+                    print "%20s %s %d -> %d" % ("", what, was, now)
+                if now > was:
+                    regressions.append("%s %s %d -> %d" % (name, what, was, now))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="renders per case, the median is reported")
+    parser.add_argument("--out", help="results file (default: bench/results/"
+                                      "render-<time>.json)")
+    parser.add_argument("--compare", help="earlier results to compare to")
+    parser.add_argument("--record", action="store_true",
+                        help="fetch Chart API responses missing from "
+                             "fixtures/charts.json and save them there")
+    parser.add_argument("-v", action="store_true", help="debug logging")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.v else logging.ERROR)
+
+    corpus = json.load(open(CORPUS))
+    recorded = json.load(open(CHARTS)) if os.path.exists(CHARTS) else {}
+    replay = Replay(corpus, recorded, args.record)
+    urlfetch.HANDLERS.append(replay)
+
+    results = {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'compositor': COMPOSITOR.name,
+        'pil': images._PIL is not None,
+        'repeat': args.repeat,
+        'cases': run(corpus, args.repeat),
+        'synthesized_charts': len(replay.synthesized),
+    }
+    print "%d Chart API responses synthesized (not in %s)" % (
+        len(replay.synthesized), os.path.relpath(CHARTS))
+
+    if args.record:
+        json.dump(recorded, open(CHARTS, "w"), indent=1, sort_keys=True)
+    out = args.out
+    if not out:
+        if not os.path.isdir(RESULTS):
+            os.makedirs(RESULTS)
+        out = os.path.join(RESULTS, "render-%s.json"
+                                    % time.strftime("%Y%m%d-%H%M%S"))
+    json.dump(results, open(out, "w"), indent=1, sort_keys=True)
+    print "Results saved to %s" % out
+
+    if args.compare:
+        regressions = compare(json.load(open(args.compare)), results)
+        for regression in regressions:
+            print "REGRESSION: %s" % regression
+        sys.exit(1 if regressions else 0)
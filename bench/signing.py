@@ -0,0 +1,95 @@
+"""Benchmark: Twitter API request signing and per-request overhead.
+
+Signatures per second of `oauth.OAuthClient.prepare_request`, which
+derives its key and encodes every parameter on each call, against the
+long-lived `twitter.Client`. Then requests per second against a local
+stub server, with a new connection per request and with `twitter`'s
+connection pool. Runs offline, no App Engine needed:
+
+    python bench/signing.py [--seconds 2]
+"""
+
+import argparse
+import BaseHTTPServer
+import os
+import SocketServer
+import sys
+import threading
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCH, "standins"), os.path.join(BENCH, "..")]
+
+import oauth
+import twitter
+
+
+URL = "%s/statuses/lookup.json" % twitter.API
+PARAMS = {'map': "true", 'include_entities': "true",
+          'id': ",".join(str(490800000000000000 + i) for i in range(100))}
+
+
+class Stub(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # One write per response, sent right away
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = '{"id": {}}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def rate(fn, seconds):
+    """Calls of `fn` per second, over about `seconds`."""
+    calls, started = 0, time.time()
+    while time.time() - started < seconds:
+        for _i in range(10):
+            fn()
+        calls += 10
+    return calls / (time.time() - started)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seconds", type=float, default=2,
+                        help="time per measurement")
+    args = parser.parse_args()
+
+    old = oauth.TwitterClient("key", "secret", None)
+    new = twitter.Client("key", "secret", "token", "token secret")
+    pairs = [(twitter._encode(k), twitter._encode(v)) for k, v in PARAMS.items()]
+    signing = [
+        ("oauth.prepare_request", lambda: old.prepare_request(
+            URL, "token", "token secret", PARAMS)),
+        ("twitter.Client", lambda: new.request(URL, PARAMS)),
+        ("  authorization only", lambda: new.authorization(URL, pairs)),
+    ]
+    new.transport = lambda url, headers: None
+    for name, fn in signing:
+        print "%-24s %8.0f signatures/s" % (name, rate(fn, args.seconds))
+
+    server = Server(("127.0.0.1", 0), Stub)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    stub = "http://127.0.0.1:%d/1.1/statuses/lookup.json" % server.server_port
+    for name, pool in [("new connections", twitter.ConnectionPool(0)),
+                       ("pooled", twitter.ConnectionPool())]:
+        new.transport = pool
+        per_second = rate(lambda: new.request(stub, PARAMS), args.seconds)
+        print "%-24s %8.0f requests/s %6.3fms each  %s" % (
+            name, per_second, 1000 / per_second, pool.stats())
+        pool.close()
+    server.shutdown()
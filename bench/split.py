@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Benchmark: Chart API calls per tweet when splitting overlong words.
+
+Compares the old word halving against character-level fitting on a
+CJK/URL-heavy corpus. The Chart API is simulated with the glyph-width
+model, skewed a bit so that predictions aren't exact, and refuses (400)
+texts wider than it can render. Runs offline, no App Engine needed:
+
+    python bench/split.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import glyphs
+import layout
+
+
+MAX_WIDTH = 500
+CHART_MAX_WIDTH = 1000
+SKEW = 1.04
+
+CORPUS = [
+    ('cjk', u"今日はとても良い天気ですね。公園を散歩して、カフェでコーヒーを飲みました。"
+            u"帰り道に本屋に寄って新しい小説を買いました。明日も晴れるといいな。"),
+    ('cjk', u"日本語のテキストはスペースがないのでとても長い単語になってしまいます。"
+            u"これは問題です。とても長いですよ本当に。"),
+    ('cjk', u"我们今天去了长城，风景非常美丽，但是人太多了。下次想在秋天再去一次，"
+            u"那时候的红叶一定很漂亮。"),
+    ('cjk', u"오늘 회의에서새로운프로젝트계획을발표했습니다 모두들매우긍정적인반응을보여주었어요"),
+    ('url', u"Read this: https://example.com/2014/07/20/a-very-long-article-slug-"
+            u"about-rendering-text-with-remote-apis?utm_source=twitter&utm_medium=social"),
+    ('url', u"http://www.example.org/downloads/releases/stable/linux/x86_64/"
+            u"package-1.2.3-final-build-4567.tar.gz mirror: http://mirror.example.net/"
+            u"pub/releases/package-1.2.3-final-build-4567.tar.gz"),
+    ('url', u"#longhashtagwithoutanyspacesatallbecausewhynot @averyveryverylongusername "
+            u"https://t.co/AbCdEfGhIj"),
+    ('mixed', u"ニュース: https://news.example.jp/articles/2014/07/20/"
+              u"technology/rendering-japanese-text-in-images 詳細はこちらをご覧ください。"),
+]
+
+
+def _chart(text):
+    width = int(glyphs.MODEL.predict(text) * SKEW)
+    return None if width > CHART_MAX_WIDTH else ("img", width)
+
+def break_lines(text, split_chars, predict=None, fanout=1):
+    """Breaks `text` into lines like _gen_shot does. Returns the number of
+    Chart API requests without and with the fragment cache, how many of
+    the latter were refused, and the number of lines."""
+    requests, rendered = [0], {}
+
+    def measure(texts):
+        requests[0] += len(texts)
+        for t in texts:
+            if t not in rendered:
+                rendered[t] = _chart(t)
+        return [rendered[t] for t in texts]
+
+    words, lines = text.split(), 0
+    while words:
+        mid, img, _rounds = layout.fit_words(words, MAX_WIDTH, measure,
+                                             predict, fanout)
+        if not img:
+            if split_chars:
+                clusters = glyphs.graphemes(words[0])
+                cut, img, _rounds = layout.fit_chars(clusters, MAX_WIDTH,
+                                                     measure, predict, fanout)
+                words[0:1] = filter(None, [u"".join(clusters[:cut]),
+                                           u"".join(clusters[cut:])])
+                mid = 1
+            else:
+                s = len(words[0]) / 2
+                words[0:1] = [words[0][:s], words[0][s:]]
+                continue
+        lines += 1
+        words = words[mid:]
+    refused = sum(1 for r in rendered.values() if r is None)
+    return requests[0], len(rendered), refused, lines
+
+
+if __name__ == "__main__":
+    strategies = (
+        ("halving", dict(split_chars=False)),
+        ("chars", dict(split_chars=True)),
+        ("chars+model", dict(split_chars=True, predict=glyphs.MODEL.predict)),
+    )
+    print "Chart API requests per tweet: uncached/cached (refused), lines"
+    print "%-6s%s" % ("", "".join("%22s" % name for name, _kw in strategies))
+    totals = [[0, 0, 0] for _s in strategies]
+    for kind, text in CORPUS:
+        row = []
+        for total, (name, kw) in zip(totals, strategies):
+            uncached, cached, refused, lines = break_lines(text, **kw)
+            total[:] = uncached + total[0], cached + total[1], refused + total[2]
+            row.append("%3d/%3d (%2d), %d ln" % (uncached, cached, refused, lines))
+        print "%-6s%s" % (kind, "".join("%22s" % r for r in row))
+    n = float(len(CORPUS))
+    print "%-6s%s" % ("mean", "".join("%22s" % ("%5.1f/%4.1f (%4.1f)    "
+                                               % tuple(t / n for t in total))
+                                      for total in totals))
@@ -0,0 +1,9 @@
+"""Local stand-ins for the App Engine APIs the renderer uses, so it can be
+benchmarked offline. Put this directory first on `sys.path`; `install`
+routes fetches to handlers of the benchmark's choosing.
+
+They model the interfaces, not the services: memcache is a dict with the
+1MB value limit, urlfetch calls handlers synchronously, images works on
+real pixels if PIL is available and on blank images of the right size
+otherwise.
+"""
@@ -0,0 +1,123 @@
+"""The images API on PIL, or without it on blank images of the right size.
+
+Like the real thing, composite overwrites pixels rather than blending them,
+except for the layer opacity. COMPOSITES counts composite calls.
+"""
+
+from cStringIO import StringIO
+import struct
+import zlib
+
+try:
+    from PIL import Image as _PIL
+except ImportError:
+    _PIL = None
+
+TOP_LEFT, TOP_CENTER, TOP_RIGHT, CENTER_LEFT, CENTER_CENTER, CENTER_RIGHT, \
+    BOTTOM_LEFT, BOTTOM_CENTER, BOTTOM_RIGHT = range(9)
+PNG, JPEG, WEBP = range(3)
+
+COMPOSITES = [0]
+
+
+class Error(Exception):
+    pass
+
+class BadImageError(Error):
+    pass
+
+
+def blank(width, height):
+    """A transparent RGBA PNG."""
+    def _chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+    raw = ("\0" + "\0" * (width * 4)) * height
+    return ("\x89PNG\r\n\x1a\n"
+            + _chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+            + _chunk("IDAT", zlib.compress(raw))
+            + _chunk("IEND", ""))
+
+def _size(data):
+    if not data or not data.startswith("\x89PNG"):
+        if _PIL is None:
+            raise BadImageError()
+        try:
+            return _PIL.open(StringIO(data)).size
+        except IOError:
+            raise BadImageError()
+    return struct.unpack(">II", data[16:24])
+
+def _encode(img, encoding, quality=None):
+    out = StringIO()
+    if encoding == JPEG:
+        img.convert("RGB").save(out, "JPEG", quality=quality or 85)
+    else:
+        # No WebP in old PILs, PNG has to do
+        img.save(out, "PNG")
+    return out.getvalue()
+
+
+class Image(object):
+    def __init__(self, image_data=None):
+        self._data = image_data
+        self.width, self.height = _size(image_data)
+        self._crop = None
+
+    def crop(self, left_x, top_y, right_x, bottom_y):
+        self._crop = left_x, top_y, right_x, bottom_y
+
+    def execute_transforms(self, output_encoding=PNG, quality=None):
+        if self._crop:
+            return crop(self._data, *self._crop, output_encoding=output_encoding)
+        if _PIL is None:
+            return self._data
+        return _encode(_PIL.open(StringIO(self._data)), output_encoding, quality)
+
+
+def _data(image):
+    return image._data if isinstance(image, Image) else image
+
+def crop(image_data, left_x, top_y, right_x, bottom_y, output_encoding=PNG):
+    data = _data(image_data)
+    width, height = _size(data)
+    box = (int(round(left_x * width)), int(round(top_y * height)),
+           int(round(right_x * width)), int(round(bottom_y * height)))
+    if _PIL is None:
+        return blank(box[2] - box[0], box[3] - box[1])
+    return _encode(_PIL.open(StringIO(data)).crop(box), output_encoding)
+
+def resize(image_data, width=0, height=0, output_encoding=PNG, **kw):
+    data = _data(image_data)
+    w, h = _size(data)
+    if not height:
+        height = max(h * width / w, 1)
+    elif not width:
+        width = max(w * height / h, 1)
+    else:
+        scale = min(float(width) / w, float(height) / h)
+        width, height = max(int(w * scale), 1), max(int(h * scale), 1)
+    if _PIL is None:
+        return blank(width, height)
+    img = _PIL.open(StringIO(data)).convert("RGBA")
+    return _encode(img.resize((width, height), _PIL.ANTIALIAS), output_encoding)
+
+def composite(inputs, width, height, color=0, output_encoding=PNG):
+    COMPOSITES[0] += 1
+    if len(inputs) > 16:
+        raise BadImageError("Too many layers")
+    if _PIL is None:
+        return blank(width, height)
+    a, r, g, b = [(color >> shift) & 0xff for shift in (24, 16, 8, 0)]
+    canvas = _PIL.new("RGBA", (width, height), (r, g, b, a))
+    for data, x, y, opacity, anchor in inputs:
+        layer = _PIL.open(StringIO(_data(data))).convert("RGBA")
+        w, h = layer.size
+        x += (width - w) * (anchor % 3) / 2
+        y += (height - h) * (anchor / 3) / 2
+        if opacity < 1.:
+            mask = layer.split()[3].point(lambda v: int(v * opacity))
+            canvas.paste(layer, (x, y), mask)
+        else:
+            canvas.paste(layer, (x, y))
+    return _encode(canvas, output_encoding)
@@ -0,0 +1,77 @@
+"""memcache in a dict, with expiry and the value size limit."""
+
+import cPickle as pickle
+import time as _time
+
+MAX_VALUE_SIZE = 10**6
+
+_items = {}
+
+
+def flush_all():
+    _items.clear()
+    return True
+
+def _live(key):
+    item = _items.get(key)
+    if item and item[1] and item[1] < _time.time():
+        del _items[key]
+        return None
+    return item
+
+def get(key, namespace=None):
+    item = _live(key)
+    return pickle.loads(item[0]) if item else None
+
+def get_multi(keys, key_prefix='', namespace=None):
+    found = {}
+    for key in keys:
+        item = _live(key_prefix + key)
+        if item:
+            found[key] = pickle.loads(item[0])
+    return found
+
+def set(key, value, time=0, namespace=None):
+    data = pickle.dumps(value, -1)
+    if len(data) > MAX_VALUE_SIZE:
+        # As the SDK does
+        raise ValueError("Values may not be more than %d bytes in length; "
+                         "received %d bytes" % (MAX_VALUE_SIZE, len(data)))
+    _items[key] = data, time and _time.time() + time
+    return True
+
+def set_multi(mapping, time=0, key_prefix='', namespace=None):
+    return [key for key, value in mapping.items()
+            if not set(key_prefix + key, value, time)]
+
+def add(key, value, time=0, namespace=None):
+    if _live(key):
+        return False
+    return set(key, value, time)
+
+def delete(key, seconds=0, namespace=None):
+    return 2 if _items.pop(key, None) else 1
+
+def delete_multi(keys, seconds=0, key_prefix='', namespace=None):
+    for key in keys:
+        _items.pop(key_prefix + key, None)
+    return True
+
+def incr(key, delta=1, namespace=None, initial_value=None):
+    item = _live(key)
+    if item is None:
+        if initial_value is None:
+            return None
+        value = initial_value + delta
+    else:
+        value = pickle.loads(item[0]) + delta
+    set(key, value, item and item[1] and item[1] - _time.time() or 0)
+    return value
+
+def decr(key, delta=1, namespace=None, initial_value=None):
+    value = incr(key, -delta, namespace, initial_value)
+    if value is not None and value < 0:
+        item = _live(key)
+        set(key, 0, item and item[1] and item[1] - _time.time() or 0)
+        value = 0
+    return value
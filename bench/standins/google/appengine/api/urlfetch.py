@@ -0,0 +1,54 @@
+"""urlfetch answering from handlers: `handler(url, method, headers,
+payload)` returns a `Response` or None to pass. Every call is logged in
+CALLS."""
+
+GET, POST, HEAD, PUT, DELETE = range(1, 6)
+
+CALLS = []
+HANDLERS = []
+
+
+class Error(Exception):
+    pass
+
+class DownloadError(Error):
+    pass
+
+
+class Response(object):
+    def __init__(self, status_code, content, headers=None):
+        self.status_code, self.content = status_code, content
+        self.headers = headers or {}
+
+
+def _route(url, method, headers, payload):
+    CALLS.append(url)
+    for handler in HANDLERS:
+        rs = handler(url, method, headers, payload)
+        if rs is not None:
+            return rs
+    return Response(404, "")
+
+def fetch(url, payload=None, method=GET, headers={}, deadline=None, **kw):
+    return _route(url, method, headers, payload)
+
+
+class RPC(object):
+    def __init__(self, deadline=None, callback=None):
+        self.deadline, self.callback = deadline, callback
+        self._result = None
+
+    def get_result(self):
+        return self._result
+
+    def wait(self):
+        pass
+
+def create_rpc(deadline=None, callback=None):
+    return RPC(deadline, callback)
+
+def make_fetch_call(rpc, url, payload=None, method=GET, headers={}, **kw):
+    rpc._result = _route(url, method, headers, payload)
+    if rpc.callback:
+        rpc.callback()
+    return rpc
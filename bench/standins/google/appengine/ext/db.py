@@ -0,0 +1,41 @@
+"""Datastore models kept in a dict, by kind and key name."""
+
+_entities = {}
+
+Blob = str
+
+
+def _property(*args, **kw):
+    return None
+
+BlobProperty = DateTimeProperty = IntegerProperty = StringProperty = \
+    TextProperty = ListProperty = _property
+
+
+class Model(object):
+    def __init__(self, key_name=None, **kw):
+        self.key_name = key_name
+        self.__dict__.update(kw)
+
+    def put(self):
+        put([self])
+
+    @classmethod
+    def get_by_key_name(cls, key_names):
+        if isinstance(key_names, list):
+            return [_entities.get((cls.__name__, k)) for k in key_names]
+        return _entities.get((cls.__name__, key_names))
+
+
+def put(models):
+    for model in models:
+        _entities[type(model).__name__, model.key_name] = model
+
+def put_async(models):
+    put(models)
+    return _Done()
+
+
+class _Done(object):
+    def get_result(self):
+        return None
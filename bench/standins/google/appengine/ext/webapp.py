@@ -0,0 +1,45 @@
+"""Just enough of webapp to import the handlers and call them directly."""
+
+
+class _Output(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+
+class Request(object):
+    def __init__(self, params=None, headers=None, path="/"):
+        self.params, self.headers, self.path = params or {}, headers or {}, path
+
+    def get(self, name, default_value=""):
+        return self.params.get(name, default_value)
+
+
+class Response(object):
+    def __init__(self):
+        self.headers, self.out, self.status = {}, _Output(), 200
+
+    def set_status(self, status):
+        self.status = status
+
+
+class RequestHandler(object):
+    def initialize(self, request, response):
+        self.request, self.response = request, response
+
+    def error(self, code):
+        self.response.set_status(code)
+
+    def redirect(self, uri, permanent=False):
+        self.response.set_status(301 if permanent else 302)
+        self.response.headers['Location'] = uri
+
+
+class WSGIApplication(object):
+    def __init__(self, url_mapping, debug=False):
+        self.url_mapping = url_mapping
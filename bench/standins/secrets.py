@@ -0,0 +1,4 @@
+CONSUMER_KEY = "bench-consumer-key"
+CONSUMER_SECRET = "bench-consumer-secret"
+CLIENT_TOKEN = "bench-client-token"
+CLIENT_SECRET = "bench-client-secret"
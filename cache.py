@@ -0,0 +1,172 @@
+"""Small caching helpers: a bounded in-process LRU, one that only admits
+values asked for repeatedly, and a two-tier cache that puts one in front
+of memcache."""
+
+from collections import OrderedDict
+from hashlib import sha1
+import logging
+from threading import Lock
+import time
+
+from google.appengine.api import memcache
+
+
+class LRUCache(object):
+    """Thread-safe LRU bounded by item count and, optionally, by the total
+    size of the values."""
+
+    def __init__(self, max_items=1000, max_bytes=None, sizeof=len):
+        self.max_items, self.max_bytes, self.sizeof = max_items, max_bytes, sizeof
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None, count=True):
+        """The value of `key`, or `default`; counted in the stats if
+        `count`."""
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                self.misses += count
+                return default
+            self._items[key] = value, size
+            self.hits += count
+            return value
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = self.sizeof(value)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self._bytes -= old[1]
+            self._items[key] = value, size
+            self._bytes += size
+            while self._items and (len(self._items) > self.max_items
+                                   or self.max_bytes and self._bytes > self.max_bytes):
+                _key, (_value, evicted) = self._items.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self._bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            'items': len(self._items),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class TwoTierCache(object):
+    """In-process LRU backed by memcache, which is shared by all instances.
+
+    Keys can be any hashable with a stable `repr`; memcache keys are
+    hashed, since the raw keys may be long or contain unicode."""
+
+    def __init__(self, prefix, local, time=0):
+        self.prefix, self.local, self.time = prefix, local, time
+        self.shared_hits = self.shared_misses = 0
+
+    def _key(self, key):
+        return self.prefix + sha1(repr(key)).hexdigest()
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        try:
+            value = memcache.get(self._key(key))
+        except Exception, e:
+            logging.warning("memcache get failed: %s" % e)
+            value = None
+        if value is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        try:
+            memcache.set(self._key(key), value, time=self.time)
+        except Exception, e:
+            logging.warning("memcache set failed: %s" % e)
+
+    def stats(self):
+        stats = {'local': self.local.stats(),
+                 'shared_hits': self.shared_hits,
+                 'shared_misses': self.shared_misses}
+        lookups = self.local.hits + self.local.misses
+        if lookups:
+            stats['hit_ratio'] = (self.local.hits + self.shared_hits) / float(lookups)
+        return stats
+
+
+class AdmittingCache(object):
+    """In-process cache for the hot few of many keys: a value is only kept
+    once its key has missed `admit_after` times, so keys asked for once
+    don't evict the hot ones. The misses of the latest `doorkeeper` keys
+    are counted; lookups that aren't demand for a value, like polls, pass
+    `count=False`. Values larger than 1/16 of the LRU's byte budget aren't
+    kept at all. Each value expires at the time it's set with."""
+
+    def __init__(self, local, admit_after=2, doorkeeper=10000):
+        self.local, self.admit_after = local, admit_after
+        self._misses = LRUCache(max_items=doorkeeper, sizeof=lambda n: 0)
+        self.rejected = self.expired = 0
+
+    def get(self, key, count=True):
+        entry = self.local.get(key, count=count)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.time():
+                return value
+            self.local.delete(key)
+            self.expired += count
+        if count:
+            self._misses.set(key, self._misses.get(key, 0) + 1)
+        return None
+
+    def set(self, key, value, expires):
+        """Keeps `value` until `expires` if `key` is hot enough. Returns
+        whether it was kept."""
+        size = self.local.sizeof(value)
+        if key not in self.local and (
+                self._misses.get(key, 0) < self.admit_after
+                or self.local.max_bytes and size > self.local.max_bytes / 16):
+            self.rejected += 1
+            return False
+        self.local.set(key, (value, expires), size)
+        return True
+
+    def clear(self):
+        self.local.clear()
+        self._misses.clear()
+
+    def stats(self):
+        stats = self.local.stats()
+        lookups = self.local.hits + self.local.misses
+        stats.update(rejected=self.rejected, expired=self.expired,
+                     hit_ratio=(self.local.hits - self.expired) / float(lookups or 1))
+        return stats
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Text rendering through the Google Chart API outlined text icons.
+
+Rendered fragments are memoized along with their pixel widths, so repeated
+texts (binary search probes, colour pass prefixes, footers) neither go
+back to the Chart API nor need to be decoded for their width.
+"""
+
+from collections import namedtuple
+import logging
+from urllib2 import quote
+
+from google.appengine.api import images, urlfetch
+
+from cache import LRUCache, TwoTierCache
+import metrics
+
+
+class ChartAPIException(Exception):
+    def __init__(self, response):
+        super(ChartAPIException, self) \
+            .__init__("Google chart API error %d" % response.status_code)
+        self.response = response
+
+
+Fragment = namedtuple('Fragment', 'img width')
+
+# Stands in for the response of a cached 400 (text too wide), which is
+# remembered as a `Fragment` without an image
+Refusal = namedtuple('Refusal', 'status_code content')
+
+FRAGMENTS = TwoTierCache("frag:",
+                         LRUCache(max_items=2000, max_bytes=8 * 2**20,
+                                  sizeof=lambda fragment: len(fragment.img or "")),
+                         time=7 * 24 * 60 * 60)
+
+
+def text_url(text, color="000000", size=23, outline="f7f7f7"):
+    return ("http://chart.apis.google.com/chart?"
+            "chst=d_text_outline&chld=%s|%d|l|%s|_|%s"
+            "&chf=bg,s,ffffff"
+            % (color, size, outline, quote(text.encode('utf-8'))))
+
+def text_imgs(texts, color="000000", size=23, outline="f7f7f7"):
+    """Renders several texts in parallel.
+
+    Returns `(results, fetched)`: a `Fragment` per text, or the
+    `ChartAPIException` if rendering it failed, and the number of Chart API
+    requests that had to be made. Texts refused with a 400 are remembered
+    as well, those are probes that came out too wide."""
+    keys = [(text, color, size, outline) for text in texts]
+    results = [FRAGMENTS.get(key) for key in keys]
+    results = [ChartAPIException(Refusal(400, ""))
+               if fragment and fragment.img is None else fragment
+               for fragment in results]
+
+    rpcs = {}
+    for key, fragment in zip(keys, results):
+        if fragment is None and key not in rpcs:
+            url = text_url(*key)
+            logging.debug("Chart API request %r" % url)
+            rpcs[key] = urlfetch.create_rpc(deadline=10)
+            urlfetch.make_fetch_call(rpcs[key], url)
+    if rpcs:
+        metrics.count("chart_calls", len(rpcs))
+
+    fetched = {}
+    for key, rpc in rpcs.items():
+        rs = rpc.get_result()
+        if rs.status_code == 200:
+            fetched[key] = Fragment(rs.content, images.Image(rs.content).width)
+            FRAGMENTS.set(key, fetched[key])
+        else:
+            logging.debug("Error content: %r" % rs.content)
+            fetched[key] = ChartAPIException(rs)
+            if rs.status_code == 400:
+                FRAGMENTS.set(key, Fragment(None, None))
+
+    return [fragment or fetched[key]
+            for key, fragment in zip(keys, results)], len(rpcs)
@@ -0,0 +1,167 @@
+"""Precomposed tweet card chrome.
+
+The empty rounded card only depends on the template and the number of text
+lines, so it's sliced and composed once per line count and reused, instead
+of re-cropping the template and stacking line strips on every render.
+
+With a compositor that blends alpha the card is a single layer. But
+images.composite overwrites pixels instead of blending, so for it the card
+can't have transparent corners; it's kept as a handful of opaque slices
+leaving the 3x3 corners out, plus the translucent corner dust that has to
+blend with whatever background is under it. Both kinds are kept, so a
+render that falls back to the images API (see `compositor`) gets the
+opaque one.
+"""
+
+from hashlib import sha1
+import logging
+from threading import Lock
+
+from google.appengine.api import images, memcache
+
+from compositor import COMPOSITOR
+import pipeline
+
+
+PADDING, LINE = 25, 30
+
+# Enough lines for the longest tweet split at every character
+MAX_LINES = 20
+
+# (x, y, opacity) of the corner dust pixels, relative to each corner
+CORNER_DUST = ((1, 1, .8), (2, 0, .5), (0, 2, .5),
+               (2, 1, 1.), (2, 2, 1.), (1, 2, 1.))
+
+
+_files = {}
+
+def read(name):
+    """Contents of a bundled image file, read once per instance."""
+    data = _files.get(name)
+    if data is None:
+        data = _files[name] = open(name, "rb").read()
+    return data
+
+
+class Chrome(object):
+    """Card slices for a template, cached per line count on the instance and
+    in memcache."""
+
+    def __init__(self, template="tweet-bg.png", pix="pix.png",
+                 compositor=COMPOSITOR):
+        self.template, self.pix = template, pix
+        self.compositor = compositor
+        self._cards, self._lock = {}, Lock()
+        self._size = None
+
+    @property
+    def size(self):
+        """`(width, height)` of the template, i.e. a one-line card."""
+        if self._size is None:
+            tmpl = images.Image(read(self.template))
+            self._size = tmpl.width, tmpl.height
+        return self._size
+
+    def card_size(self, lines):
+        t_width, t_height = self.size
+        return t_width, t_height + (lines - 1) * LINE
+
+    def _key(self, lines, blends):
+        digest = sha1(read(self.template) + read(self.pix)).hexdigest()
+        return "card:%s:%s:%d" % (digest[:16], "blend" if blends else "opaque",
+                                  lines)
+
+    def card(self, lines, blends=None):
+        """Composition layers `(img, x, y, opacity, anchor)` of the empty
+        card for `lines` lines of text, relative to the card's top left, for
+        a compositor that `blends` alpha or not (default: like
+        `compositor`)."""
+        if blends is None:
+            blends = self.compositor.blends
+        layers = self._cards.get((lines, blends))
+        if layers is None:
+            key = self._key(lines, blends)
+            layers = memcache.get(key)
+            if layers is None:
+                layers = self._build(lines, blends)
+                memcache.set(key, layers)
+            with self._lock:
+                self._cards[lines, blends] = layers
+        return layers
+
+    def warm(self, max_lines=MAX_LINES):
+        """Loads or builds the cards for every line count."""
+        blends = self.compositor.blends
+        missing = [n for n in range(1, max_lines + 1)
+                   if (n, blends) not in self._cards]
+        cached = memcache.get_multi([self._key(n, blends) for n in missing])
+        with self._lock:
+            for n in missing:
+                if self._key(n, blends) in cached:
+                    self._cards[n, blends] = cached[self._key(n, blends)]
+        for n in missing:
+            self.card(n)
+
+    def _build(self, lines, blends):
+        logging.info("Building %d-line card from %s" % (lines, self.template))
+        tmpl_data, pix = read(self.template), read(self.pix)
+        t_width, t_height = self.size
+        width, height = self.card_size(lines)
+        PADDINGF = float(PADDING)
+
+        # Damn the rounded corners; need to seriously slice and re-compose
+
+        # The crops don't depend on each other, they're made at once
+        px3 = 3. / t_width
+        crop = lambda *box: lambda: images.crop(tmpl_data, *box)
+        top1, top2, line_bg, bottom1, bottom2 = pipeline.parallel(
+            crop(px3, 0., 1. - px3, PADDINGF / t_height),
+            crop(0., 3. / t_height, 1., PADDINGF / t_height),
+            crop(0., PADDINGF / t_height, 1., (PADDINGF + LINE) / t_height),
+            crop(px3, (PADDINGF + LINE) / t_height, 1 - px3, 1.),
+            crop(0., (PADDINGF + LINE) / t_height, 1., 1 - 3. / t_height))
+
+        footer_y = PADDING + lines * LINE
+        layers = [(top1, 3, 0, 1., images.TOP_LEFT),
+                  (top2, 0, 3, 1., images.TOP_LEFT)] \
+                 + [(line_bg, 0, PADDING + n * LINE, 1., images.TOP_LEFT)
+                    for n in range(lines)] \
+                 + [(bottom1, 3, footer_y, 1., images.TOP_LEFT),
+                    (bottom2, 0, footer_y, 1., images.TOP_LEFT)] \
+                 + [(pix, fx(x), fy(y), a, images.TOP_LEFT)
+                    for fx, fy in self._corners(width, height)
+                    for x, y, a in CORNER_DUST
+                    if a == 1. or blends]
+
+        # Transparent white, so translucent dust blended onto it stays white
+        card = self.compositor.composite(layers, width, height, 0x00ffffff)
+        if blends:
+            return [(card, 0, 0, 1., images.TOP_LEFT)]
+
+        def _slice(x0, y0, x1, y1):
+            return lambda: (images.crop(card, float(x0) / width, float(y0) / height,
+                                        float(x1) / width, float(y1) / height),
+                            x0, y0, 1., images.TOP_LEFT)
+
+        # Opaque slices leave out the corner pixels covered by translucent
+        # dust (or nothing)
+        return pipeline.parallel(_slice(3, 0, width - 3, 1),
+                                 _slice(2, 1, width - 2, 2),
+                                 _slice(1, 2, width - 1, 3),
+                                 _slice(0, 3, width, height - 3),
+                                 _slice(1, height - 3, width - 1, height - 2),
+                                 _slice(2, height - 2, width - 2, height - 1),
+                                 _slice(3, height - 1, width - 3, height)) \
+               + [(pix, fx(x), fy(y), a, images.TOP_LEFT)
+                  for fx, fy in self._corners(width, height)
+                  for x, y, a in CORNER_DUST if a < 1.]
+
+    @staticmethod
+    def _corners(width, height):
+        yield (lambda x: x), (lambda y: y)
+        yield (lambda x: width - x - 1), (lambda y: y)
+        yield (lambda x: x), (lambda y: height - y - 1)
+        yield (lambda x: width - x - 1), (lambda y: height - y - 1)
+
+
+CHROME = Chrome()
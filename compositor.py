@@ -0,0 +1,151 @@
+"""Compositing backends.
+
+A composition is a list of `(img, x, y, opacity, anchor)` layers, as taken
+by `images.composite`, where `img` is encoded image data.
+
+`ImagesCompositor` stacks the layers with the App Engine images API, 15 at a
+time, re-encoding the whole canvas between batches. `RasterCompositor`
+decodes each distinct layer once, blends everything onto one in-memory RGBA
+canvas and encodes once at the end. It needs PIL (the `PIL` library in
+app.yaml); without it, or if it fails, the images API is used.
+
+Layers can depend on whether the compositor blends alpha (see `chrome`);
+then the composition is given as a function of `blends` that returns the
+layers, and the backend that actually composites asks for its own.
+"""
+
+from cStringIO import StringIO
+import logging
+
+from google.appengine.api import images
+
+import metrics
+import settings
+
+try:
+    from PIL import Image, ImageChops
+except ImportError:
+    Image = ImageChops = None
+
+
+def _layers(components, blends):
+    return components(blends) if callable(components) else components
+
+
+class ImagesCompositor(object):
+    """The images API; overwrites pixels instead of blending alpha, except
+    for the layer opacity."""
+
+    name = "images"
+    blends = False
+
+    def composite(self, components, width, height, color=0):
+        components = list(_layers(components, self.blends))
+        canvas = components.pop(0)
+        if not components:
+            # Single layer still needs to be put on a canvas of the size
+            metrics.count("composite_passes")
+            img = images.composite([canvas], width, height, color)
+            metrics.count("composite_bytes", len(img))
+            return img
+        while components:
+            batch, components = components[:15], components[15:]
+            metrics.count("composite_passes")
+            canvas = (images.composite([canvas] + batch, width, height, color),
+                      0, 0, 1., images.TOP_LEFT)
+            metrics.count("composite_bytes", len(canvas[0]))
+        return canvas[0]
+
+
+def _anchored(anchor, x, y, size, width, height):
+    """Top left position of a layer of `size` anchored on the canvas like
+    images.composite does."""
+    w, h = size
+    col = {images.TOP_LEFT: 0, images.CENTER_LEFT: 0, images.BOTTOM_LEFT: 0,
+           images.TOP_CENTER: 1, images.CENTER_CENTER: 1, images.BOTTOM_CENTER: 1,
+           images.TOP_RIGHT: 2, images.CENTER_RIGHT: 2, images.BOTTOM_RIGHT: 2}[anchor]
+    row = {images.TOP_LEFT: 0, images.TOP_CENTER: 0, images.TOP_RIGHT: 0,
+           images.CENTER_LEFT: 1, images.CENTER_CENTER: 1, images.CENTER_RIGHT: 1,
+           images.BOTTOM_LEFT: 2, images.BOTTOM_CENTER: 2, images.BOTTOM_RIGHT: 2}[anchor]
+    return x + (width - w) * col / 2, y + (height - h) * row / 2
+
+
+class RasterCompositor(object):
+    """Blends layers in memory by their alpha, which the images API doesn't
+    do. Colours are blended straight, not premultiplied: exact on an opaque
+    canvas, while on transparent parts the canvas colour mixes in."""
+
+    name = "raster"
+    blends = True
+
+    def composite(self, components, width, height, color=0):
+        a, r, g, b = [(color >> shift) & 0xff for shift in (24, 16, 8, 0)]
+        rgb = Image.new("RGB", (width, height), (r, g, b))
+        alpha = Image.new("L", (width, height), a)
+
+        decoded = {}
+        for img, x, y, opacity, anchor in _layers(components, self.blends):
+            layer = decoded.get(img)
+            if layer is None:
+                layer = decoded[img] = self._decode(img)
+            layer_rgb, mask = layer
+            x, y = _anchored(anchor, x, y, layer_rgb.size, width, height)
+            if opacity < 1.:
+                if mask is None:
+                    mask = Image.new("L", layer_rgb.size, int(255 * opacity + .5))
+                else:
+                    mask = mask.point(lambda v: int(v * opacity + .5))
+
+            rgb.paste(layer_rgb, (x, y), mask)
+            box = (x, y, x + layer_rgb.size[0], y + layer_rgb.size[1])
+            if mask is None:
+                alpha.paste(255, box)
+            else:
+                # a_out = a_layer + a_canvas * (1 - a_layer)
+                alpha.paste(ImageChops.screen(alpha.crop(box), mask), box)
+
+        out = StringIO()
+        Image.merge("RGBA", rgb.split() + (alpha,)).save(out, "PNG")
+        metrics.count("composite_passes")
+        metrics.count("composite_bytes", out.tell())
+        return out.getvalue()
+
+    @staticmethod
+    def _decode(data):
+        """RGB image and alpha mask (None if opaque) of encoded `data`."""
+        img = Image.open(StringIO(data))
+        if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+            img = img.convert("RGBA")
+            return img.convert("RGB"), img.split()[3]
+        return img.convert("RGB"), None
+
+
+class FallbackCompositor(object):
+    """Tries the `primary` backend and falls back to `fallback` if it
+    fails. Compositions given as functions of `blends` are asked again for
+    the layers of the fallback."""
+
+    def __init__(self, primary, fallback):
+        self.primary, self.fallback = primary, fallback
+        self.name, self.blends = primary.name, primary.blends
+
+    def composite(self, components, width, height, color=0):
+        try:
+            return self.primary.composite(components, width, height, color)
+        except Exception, e:
+            logging.exception("%s compositing failed, falling back to %s: %s"
+                              % (self.primary.name, self.fallback.name, e))
+            return self.fallback.composite(components, width, height, color)
+
+
+def get(name=None):
+    """The compositor backend named `name` (default
+    `settings.COMPOSITOR`), if available."""
+    name = name or settings.COMPOSITOR
+    if name == "raster":
+        if Image is not None:
+            return FallbackCompositor(RasterCompositor(), ImagesCompositor())
+        logging.warning("PIL not available, compositing with the images API")
+    return ImagesCompositor()
+
+COMPOSITOR = get()
@@ -0,0 +1,116 @@
+"""Output encodings of rendered images.
+
+Cards are mostly flat colours and text, so PNGs are re-encoded with a
+palette, which makes them a fraction of the size. Clients that say so in
+their Accept header get WebP or JPEG instead; those only ever go to clients
+naming them, never on a wildcard.
+"""
+
+from cStringIO import StringIO
+import logging
+from threading import Lock
+
+from google.appengine.api import images
+
+import settings
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+DEFAULT = "png"
+
+# Preference between formats a client accepts equally
+FORMATS = ("webp", "png", "jpeg")
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+
+_ENCODINGS = {"webp": images.WEBP, "jpeg": images.JPEG}
+
+_lock = Lock()
+_bytes = dict((fmt, [0, 0]) for fmt in FORMATS)
+
+
+def negotiate(accept):
+    """The format to serve for an Accept header value."""
+    if not accept:
+        return DEFAULT
+    qs = {}
+    for item in accept.split(","):
+        params = item.split(";")
+        q = 1.
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    pass
+        qs[params[0].strip().lower()] = q
+
+    def _q(fmt):
+        q = qs.get(CONTENT_TYPES[fmt])
+        if q is None and fmt == DEFAULT:
+            q = qs.get("image/*", qs.get("*/*"))
+        return q or 0.
+
+    best = max(FORMATS, key=lambda fmt: (_q(fmt), -FORMATS.index(fmt)))
+    return best if _q(best) > 0 else DEFAULT
+
+
+def _palette(data):
+    """`data` re-encoded with a palette of at most 256 colours; exact if the
+    image has that few, quantized otherwise (if `settings.PNG_QUANTIZE`)."""
+    img = Image.open(StringIO(data))
+    if img.mode == "P":
+        return data
+    if img.mode in ("RGBA", "LA"):
+        if img.split()[-1].getextrema()[0] < 255:
+            # Translucency doesn't survive the palette conversion
+            return data
+    img = img.convert("RGB")
+    colors = img.getcolors(256)
+    if colors is None and not settings.PNG_QUANTIZE:
+        return data
+    img = img.convert("P", palette=Image.ADAPTIVE,
+                      colors=len(colors) if colors else 256)
+    out = StringIO()
+    img.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+
+def encode(data, fmt=DEFAULT):
+    """PNG image `data` encoded as `fmt`; the smallest PNG we can make for
+    "png"."""
+    if fmt == "png":
+        encoded = data
+        if Image is not None:
+            try:
+                encoded = _palette(data)
+            except Exception, e:
+                logging.warning("Palette encoding failed: %s" % e)
+        encoded = min(encoded, data, key=len)
+    else:
+        img = images.Image(data)
+        # Needs a transform to re-encode; this one leaves it as it is
+        img.crop(0., 0., 1., 1.)
+        encoded = img.execute_transforms(output_encoding=_ENCODINGS[fmt],
+                                         quality=settings.LOSSY_QUALITY)
+    with _lock:
+        _bytes[fmt][0] += len(data)
+        _bytes[fmt][1] += len(encoded)
+    return encoded
+
+
+def stats():
+    """Bytes in and out of each encoding, and their ratio."""
+    with _lock:
+        return dict((fmt, {'in': bytes_in, 'out': bytes_out,
+                           'ratio': bytes_out / float(bytes_in or 1)})
+                    for fmt, (bytes_in, bytes_out) in _bytes.items())
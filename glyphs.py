@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""Local text width prediction for the Chart API outlined text font.
+
+Tweet lines are rendered remotely, so finding out whether a bunch of words
+fits on one line costs a round trip. This module predicts the width locally
+so the line search can start right at the likely break.
+
+The advance widths below are standard sans-serif (Arial-like) metrics
+scaled to 23px, not measured from the `d_text_outline` font. Run this
+module directly (with network access) to calibrate them against it:
+
+    python glyphs.py > glyph-widths.json
+
+If `glyph-widths.json` exists next to this file, it overrides the built-in
+table.
+"""
+
+import json
+import logging
+import os
+from threading import Lock
+import unicodedata
+
+
+# Calibration size; widths scale linearly with the font size
+CALIBRATION_SIZE = 23
+
+# Arial-like advance widths in pixels at 23px, printable ASCII
+ADVANCES = dict(zip(
+    u" !\"#$%&'()*+,-./0123456789:;<=>?@"
+    u"ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`"
+    u"abcdefghijklmnopqrstuvwxyz{|}~",
+    (6.4, 6.4, 8.2, 12.8, 12.8, 20.4, 15.3, 4.4, 7.7, 7.7, 8.9, 13.4, 6.4,
+     7.7, 6.4, 6.4, 12.8, 12.8, 12.8, 12.8, 12.8, 12.8, 12.8, 12.8, 12.8,
+     12.8, 6.4, 6.4, 13.4, 13.4, 13.4, 12.8, 23.3,
+     15.3, 15.3, 16.6, 16.6, 15.3, 14.1, 17.9, 16.6, 6.4, 11.5, 15.3, 12.8,
+     19.2, 16.6, 17.9, 15.3, 17.9, 16.6, 15.3, 14.1, 16.6, 15.3, 21.7, 15.3,
+     15.3, 14.1, 6.4, 6.4, 6.4, 10.8, 12.8, 7.7,
+     12.8, 12.8, 11.5, 12.8, 12.8, 6.4, 12.8, 12.8, 5.1, 5.1, 11.5, 5.1,
+     19.2, 12.8, 12.8, 12.8, 12.8, 7.7, 11.5, 6.4, 12.8, 11.5, 16.6, 11.5,
+     11.5, 11.5, 7.7, 6.0, 7.7, 13.4)))
+
+# Fallback advances for characters not in the table, per script bucket
+BUCKETS = {
+    'latin': 12.2,
+    'cjk': 23.0,
+    'emoji': 23.0,
+}
+
+# Outline and margins the Chart API adds around the text
+PADDING = 4.0
+
+
+def codepoints(text):
+    """Yields code points of `text`, joining UTF-16 surrogate pairs
+    on narrow Python builds."""
+    it = iter(text)
+    for c in it:
+        if u"\ud800" <= c <= u"\udbff":
+            low = next(it, u"")
+            if u"\udc00" <= low <= u"\udfff":
+                yield ((ord(c) - 0xd800) << 10) + (ord(low) - 0xdc00) + 0x10000
+                continue
+            yield ord(c)
+            if low:
+                yield ord(low)
+        else:
+            yield ord(c)
+
+def unichr_(cp):
+    """`unichr` that works for astral code points on narrow builds."""
+    try:
+        return unichr(cp)
+    except ValueError:
+        cp -= 0x10000
+        return unichr(0xd800 + (cp >> 10)) + unichr(0xdc00 + (cp & 0x3ff))
+
+def _extends(cp):
+    """Whether the code point attaches to the preceding grapheme cluster."""
+    if cp in (0x200c, 0x200d) or 0xfe00 <= cp <= 0xfe0f \
+            or 0x1f3fb <= cp <= 0x1f3ff or 0xe0020 <= cp <= 0xe007f:
+        # Joiners, variation selectors, skin tones, emoji tag sequences
+        return True
+    c = unichr_(cp)
+    return len(c) == 1 and unicodedata.category(c) in ('Mn', 'Me', 'Mc')
+
+def _hangul(cp):
+    """Hangul syllable type of a code point: 'L', 'V' or 'T' jamo, an 'LV'
+    or 'LVT' syllable, or None."""
+    if 0x1100 <= cp <= 0x115f or 0xa960 <= cp <= 0xa97c:
+        return 'L'
+    if 0x1160 <= cp <= 0x11a7 or 0xd7b0 <= cp <= 0xd7c6:
+        return 'V'
+    if 0x11a8 <= cp <= 0x11ff or 0xd7cb <= cp <= 0xd7fb:
+        return 'T'
+    if 0xac00 <= cp <= 0xd7a3:
+        return 'LVT' if (cp - 0xac00) % 28 else 'LV'
+    return None
+
+# Hangul syllable types that continue a syllable after each type
+HANGUL_FOLLOWS = {'L': ('L', 'V', 'LV', 'LVT'), 'V': ('V', 'T'),
+                  'LV': ('V', 'T'), 'T': ('T',), 'LVT': ('T',)}
+
+def graphemes(text):
+    """Splits `text` into (roughly) user-perceived characters: keeps
+    surrogate pairs, combining marks, ZWJ emoji sequences, flag pairs and
+    conjoining Hangul jamo together, so the text is never cut in the middle
+    of one."""
+    clusters, joined, prev = [], False, None
+    for cp in codepoints(text):
+        c = unichr_(cp)
+        kind = 'regional' if 0x1f1e6 <= cp <= 0x1f1ff else _hangul(cp)
+        if clusters and (joined or _extends(cp)
+                         or kind == prev == 'regional'
+                         or kind in HANGUL_FOLLOWS.get(prev, ())):
+            clusters[-1] += c
+            # A flag is a pair, a third regional indicator starts another
+            prev = None if kind == 'regional' else kind
+        else:
+            clusters.append(c)
+            prev = kind
+        joined = cp == 0x200d
+    return clusters
+
+def _is_emoji(cp):
+    return (0x1f000 <= cp <= 0x1faff
+            or 0x2600 <= cp <= 0x27bf
+            or 0x2b00 <= cp <= 0x2bff)
+
+def bucket(cp):
+    """Script bucket of a code point: 'latin', 'cjk', 'emoji' or None for
+    zero-width code points (combining marks, joiners, variation
+    selectors)."""
+    if _is_emoji(cp):
+        return 'emoji'
+    if cp in (0x200b, 0x200c, 0x200d, 0x2060, 0xfeff) \
+            or 0xfe00 <= cp <= 0xfe0f or 0xe0100 <= cp <= 0xe01ef:
+        return None
+    c = unichr_(cp)
+    if len(c) == 1:
+        if unicodedata.combining(c):
+            return None
+        if unicodedata.east_asian_width(c) in ('W', 'F'):
+            return 'cjk'
+    elif 0x20000 <= cp <= 0x3ffff:
+        # Supplementary ideographic planes
+        return 'cjk'
+    return 'latin'
+
+
+class WidthModel(object):
+    """Predicts rendered text widths and keeps track of how far off the
+    predictions are from what the Chart API actually returns."""
+
+    def __init__(self, advances=ADVANCES, buckets=BUCKETS, padding=PADDING,
+                 size=CALIBRATION_SIZE):
+        self.advances, self.buckets = dict(advances), dict(buckets)
+        self.padding, self.size = padding, size
+        self._lock = Lock()
+        self._n = self._sum = self._abs_sum = self._sq_sum = 0.
+        self._by_bucket = {}
+
+    def advance(self, cp, size=None):
+        """Advance width of a single code point in pixels."""
+        w = self.advances.get(unichr_(cp))
+        if w is None:
+            b = bucket(cp)
+            w = self.buckets[b] if b else 0.
+        return w * (size or self.size) / self.size
+
+    def text_width(self, text, size=None):
+        """Sum of the advance widths of `text`, without the padding."""
+        return sum(self.advance(cp, size) for cp in codepoints(text))
+
+    def predict(self, text, size=None):
+        """Predicted pixel width of the rendered image of `text`."""
+        return self.text_width(text, size) + self.padding
+
+    def dominant_bucket(self, text):
+        counts = {}
+        for cp in codepoints(text):
+            b = bucket(cp)
+            if b:
+                counts[b] = counts.get(b, 0) + 1
+        return max(counts, key=counts.get) if counts else 'latin'
+
+    def observe(self, text, actual, size=None):
+        """Records the actual rendered width of `text`. Returns the
+        prediction error in pixels (positive if predicted too wide)."""
+        error = self.predict(text, size) - actual
+        b = self.dominant_bucket(text)
+        with self._lock:
+            self._n += 1
+            self._sum += error
+            self._abs_sum += abs(error)
+            self._sq_sum += error * error
+            n, abs_sum = self._by_bucket.get(b, (0, 0.))
+            self._by_bucket[b] = (n + 1, abs_sum + abs(error))
+        logging.debug("Width of %r: predicted %.1f, actual %d"
+                      % (text, actual + error, actual))
+        return error
+
+    def stats(self):
+        with self._lock:
+            n = self._n or 1
+            return {
+                'observations': int(self._n),
+                'mean_error': self._sum / n,
+                'mean_abs_error': self._abs_sum / n,
+                'rms_error': (self._sq_sum / n) ** .5,
+                'mean_abs_error_by_bucket': dict(
+                    (b, abs_sum / bn)
+                    for b, (bn, abs_sum) in self._by_bucket.items()),
+            }
+
+
+def _load_model():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "glyph-widths.json")
+    if not os.path.exists(path):
+        return WidthModel()
+    with open(path, "rb") as f:
+        data = json.load(f)
+    return WidthModel(advances=data['advances'],
+                      buckets=data['buckets'],
+                      padding=data['padding'],
+                      size=data.get('size', CALIBRATION_SIZE))
+
+MODEL = _load_model()
+
+
+def calibrate(measure, size=CALIBRATION_SIZE, reps=10):
+    """Derives a width table from `measure(text)`, which has to return the
+    pixel width of `text` rendered by the Chart API.
+
+    Each character is measured repeated once and `reps` times; the
+    difference gives the advance and the rest the padding."""
+    def advance(c):
+        one, many = measure(c), measure(c * reps)
+        return (many - one) / float(reps - 1), one
+
+    advances, paddings = {}, []
+    for c in ADVANCES:
+        if c == u" ":
+            # Leading/trailing spaces get trimmed, measure in between
+            w = (measure(u"x" + u" " * reps + u"x") - measure(u"xx")) / float(reps)
+        else:
+            w, one = advance(c)
+            paddings.append(one - w)
+        advances[c] = round(w, 1)
+    buckets = {
+        # Median-ish representatives of each bucket
+        'latin': round(sum(advance(c)[0] for c in u"éößаα") / 5, 1),
+        'cjk': round(sum(advance(c)[0] for c in u"一文あア한") / 5, 1),
+        'emoji': round(sum(advance(c)[0]
+                           for c in (u"❤", u"☺", unichr_(0x1f600),
+                                     unichr_(0x1f44d), unichr_(0x1f525))) / 5, 1),
+    }
+    paddings.sort()
+    return {
+        'size': size,
+        'advances': advances,
+        'buckets': buckets,
+        'padding': round(paddings[len(paddings) / 2], 1),
+    }
+
+
+if __name__ == "__main__":
+    import struct
+    import sys
+    from urllib2 import quote, urlopen
+
+    def _chart_width(text):
+        rs = urlopen("http://chart.apis.google.com/chart?"
+                     "chst=d_text_outline&chld=000000|%d|l|f7f7f7|_|%s"
+                     "&chf=bg,s,ffffff"
+                     % (CALIBRATION_SIZE, quote(text.encode('utf-8'))))
+        # Width from the PNG IHDR chunk
+        return struct.unpack(">I", rs.read(24)[16:20])[0]
+
+    json.dump(calibrate(_chart_width), sys.stdout, indent=1, sort_keys=True)
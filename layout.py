@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Line fitting: how much of the tweet text fits on one line.
+
+Kept free of App Engine imports so the search logic can be exercised
+offline; the actual rendering is passed in as a callable.
+"""
+
+
+def predicted_break(units, max_width, predict, sep=u" "):
+    """Largest number of `units` whose predicted width fits in `max_width`
+    (at least 1)."""
+    for n in range(1, len(units) + 1):
+        if predict(sep.join(units[:n])) > max_width:
+            return max(1, n - 1)
+    return len(units)
+
+def _candidates(fits, too_wide, fanout, around=None):
+    """Up to `fanout` word counts to probe strictly between `fits` and
+    `too_wide`; nearest to `around` if given, else evenly spread."""
+    if around is not None:
+        order = [around]
+        for d in range(1, too_wide - fits):
+            order += [around + d, around - d]
+        picked = [n for n in order if fits < n < too_wide][:fanout]
+    else:
+        span = too_wide - fits
+        picked = set(fits + max(1, span * i / (fanout + 1))
+                     for i in range(1, fanout + 1))
+        picked = [n for n in picked if n < too_wide]
+    return sorted(set(picked))
+
+def fit_words(words, max_width, measure, predict=None, fanout=1, sep=u" "):
+    """Finds how many of the `words` fit into a line of `max_width` pixels.
+
+    `measure(texts)` renders or just measures a list of texts (in
+    parallel, if it can) and returns a list of `(img, width)`, img None if
+    only measured, with None for texts that could not be rendered at all
+    (treated as too wide).
+
+    Each round probes up to `fanout` prefix lengths at once, so the search
+    takes ~log_(fanout+1)(n) rounds. Without `predict`, the first round
+    tries all the words. With `predict(text)` giving an estimated width,
+    the first round is centered on the predicted break and, when probing
+    one at a time, the second checks its neighbour; a good prediction is
+    confirmed in one or two rounds.
+
+    Returns `(count, img, rounds)`, img that of the line of `count` words;
+    count is 0 and img None if not even the first word fits.
+
+    The words are joined with `sep`; see `fit_chars` for splitting a single
+    word.
+    """
+    fits, too_wide = 0, len(words) + 1
+    line_img, rounds = None, 0
+
+    if predict:
+        probes = _candidates(fits, too_wide, fanout,
+                             predicted_break(words, max_width, predict, sep))
+    else:
+        probes = [len(words)]
+
+    while probes:
+        results = measure([sep.join(words[:n]) for n in probes])
+        rounds += 1
+        for n, rendered in zip(probes, results):
+            if rendered and rendered[1] <= max_width:
+                if fits < n < too_wide:
+                    fits, line_img = n, rendered[0]
+            else:
+                # Probes are in ascending order, a longer one fitting after
+                # a shorter one failed is ignored
+                too_wide = min(too_wide, n)
+
+        if too_wide - fits <= 1:
+            break
+        if predict and rounds == 1 and fanout == 1:
+            # Confirm the prediction with the neighbour
+            probes = _candidates(fits, too_wide, 1,
+                                 fits + 1 if fits == probes[0] else too_wide - 1)
+        else:
+            probes = _candidates(fits, too_wide, fanout)
+
+    return fits, line_img, rounds
+
+def fit_chars(clusters, max_width, measure, predict=None, fanout=1):
+    """Finds the longest prefix of a word too wide for a line, given as a
+    list of grapheme clusters, that does fit.
+
+    Same as `fit_words`, but the units are joined without spaces, so the
+    word is cut at the optimal character in one search instead of halving
+    it and re-fitting the halves.
+    """
+    return fit_words(clusters, max_width, measure, predict, fanout, sep=u"")
@@ -0,0 +1,108 @@
+"""Stored line layouts of tweets.
+
+Fitting a tweet's text to lines is where rendering spends its remote
+calls. What comes out of it is small: the text of each line and its
+coloured segments, with their offsets. It's stored by tweet id along with
+a digest of what it was fitted from (words, colours, text backend, font,
+line width), so re-rendering the tweet, after its image was evicted or
+went stale, draws the lines right away, without a single probe.
+
+Layouts are kept in memcache and, to outlive the images, in the fallback
+store of `store` (`settings.SHOT_FALLBACK`). Neither is waited for while
+fitting: a layout is loaded alongside the tweet, from the fallback store
+only when `restore`-ing one of a tweet rendered before, and its fallback
+copy is written asynchronously.
+"""
+
+from hashlib import sha1
+import logging
+import cPickle as pickle
+from threading import Lock
+
+from google.appengine.api import memcache
+
+import store
+
+
+KEY = "layout:%s"
+
+TIME = 30 * 24 * 60 * 60
+
+# Bump when the layout record changes
+VERSION = 2
+
+
+def digest(*inputs):
+    """Digest of what a layout is fitted from."""
+    return sha1(repr((VERSION,) + inputs)).hexdigest()
+
+
+class Layouts(object):
+    """Layouts by tweet id: lists of `(text, segments, backend)` per
+    line, the segments `(color, offset, text)`, the backend the name of the
+    text backend the line is drawn with (see `typeset.chain`)."""
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback
+        self._lock = Lock()
+        self.hits = self.misses = self.outdated = self.restored = 0
+
+    def _count(self, what):
+        with self._lock:
+            setattr(self, what, getattr(self, what) + 1)
+
+    def load(self, tweet_id, restore=False):
+        """The stored layout record of `tweet_id`, for `match`. The
+        fallback store is read on a memcache miss if `restore`."""
+        key = KEY % tweet_id
+        stored = memcache.get(key)
+        if stored is None and restore and self.fallback:
+            try:
+                value = self.fallback.get(key)
+            except Exception, e:
+                logging.warning("Reading layout of %s failed: %s" % (tweet_id, e))
+                value = None
+            if value:
+                stored = pickle.loads(value[0])
+                memcache.set(key, stored, time=TIME)
+                self._count('restored')
+        return stored
+
+    def match(self, stored, digest):
+        """The layout of a `load`ed record if it was fitted from the same
+        `digest`, else None."""
+        if stored is None:
+            self._count('misses')
+            return None
+        if stored[0] != digest:
+            self._count('outdated')
+            return None
+        self._count('hits')
+        return stored[1]
+
+    def put(self, tweet_id, digest, lines):
+        """Stores a layout. The fallback store is written asynchronously:
+        returns a function waiting for that."""
+        key, stored = KEY % tweet_id, (digest, lines)
+        memcache.set(key, stored, time=TIME)
+        rpc = None
+        if self.fallback:
+            try:
+                rpc = self.fallback.set_async(key, (pickle.dumps(stored, -1),),
+                                              TIME)
+            except Exception, e:
+                logging.warning("Storing layout of %s failed: %s" % (tweet_id, e))
+
+        def wait():
+            try:
+                rpc and rpc.get_result()
+            except Exception, e:
+                logging.warning("Storing layout of %s failed: %s" % (tweet_id, e))
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'outdated': self.outdated, 'restored': self.restored}
+
+LAYOUTS = Layouts(store.fallback())
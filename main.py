@@ -5,17 +5,56 @@ from itertools import groupby
 import json
 import logging
 import os
-from random import randint
 import re
-from urllib2 import quote
+from threading import Lock
+# Imported on the request thread: the first strptime on a pipeline thread
+# may fail to import it while another thread holds the import lock
+import _strptime
 
-from google.appengine.api import images, memcache, urlfetch
+from google.appengine.api import images, memcache
 from google.appengine.ext import webapp
 
+import assets
+import banners
+import charts
+from charts import ChartAPIException, Fragment
+import chrome
+from compositor import COMPOSITOR
+import formats
+import glyphs
+import layout
+import layouts
+import metrics
 import oauth
+import pipeline
+import randompool
+import ratelimit
+from ratelimit import RateLimited
+from refresh import Refresher
 import secrets
-
-
+import settings
+import shots
+import store
+from singleflight import SingleFlight
+import tweets
+import twitter
+from twitter import TwitterAPIError
+import typeset
+
+
+ENTITY_COLORS = {
+    'urls': "0000ff",
+    'media': "0000ff",
+    'user_mentions': "0000ff",
+    'hashtags': "0000ff",
+    'symbols': "0000ff",
+}
+
+# Served when a tweet can't be rendered for now and there's no earlier
+# image of it
+PLACEHOLDER = open("overquota.png", "rb").read()
+
+# For tweets cached without their entities
 COLOR_WORDS = tuple((re.compile(pattern), color) for pattern, color in (
     (r"https?://.+", "0000ff"),
     (r"[#@].+", "0000ff"),
@@ -33,320 +72,367 @@ class ServerError(Exception):
         self.status, self.message = status, message
 
 
-class ChartAPIException(Exception):
-    def __init__(self, response):
-        super(ChartAPIException, self) \
-            .__init__("Google chart API error %d" % response.status_code)
-        self.response = response
-
-
-def chart_img(url):
-    logging.debug("Chart API request %r" % url)
-    rs = urlfetch.fetch(url, deadline=10)
-    if rs.status_code == 200:
-        return rs.content
-    else:
-        logging.debug("Error content: %r" % rs.content)
-        raise ChartAPIException(rs)
-
-def _make_twitter_request(url):
-    client = oauth.TwitterClient(secrets.CONSUMER_KEY,
-                                 secrets.CONSUMER_SECRET,
-                                 "https://%s/callback/" % os.environ['SERVER_NAME'])
-    return client.make_request(url, token=secrets.CLIENT_TOKEN,
-                               secret=secrets.CLIENT_SECRET)
-
 def first(iterable, default=None):
     for i in iterable:
         return i
     return default
 
-def _gen_shot(tweet_id):
-    tweet_rs = _make_twitter_request(
-        "https://api.twitter.com/1.1/statuses/show/%d.json" % tweet_id)
-
-    if tweet_rs.status_code != 200:
-        rs = {}
-        try:
-            rs = json.loads(tweet_rs.content)
-        except Exception, e:
-            logging.exception(e)
-        raise ServerError(500, "Twitter API error %d: %r"
-                               % (tweet_rs.status_code, rs))
-
-    # Twitter API encodes utf-8
-    assert 'utf-8' in tweet_rs.headers['Content-Type']
-
-    # Parse tweet
-    tweet = json.loads(tweet_rs.content)
-    logging.debug("Got data: %r" % tweet)
-
-    text = tweet.get('text')
-    if not text:
-        raise ServerError(404, "No tweet text")
-
-    text = reduce(lambda t, (p, s): t.replace(p, s),
-                   # Need to escape pipes for chart API
-                  (("|", u"\u05C0"),
-                   # Some manual “Twitter-JSON” unquoting
-                   ("&gt;", ">"), ("&lt;", "<")),
-                  text)
-
-    user = tweet.get('user') or {}
-    bg_rpc = prof_rpc = None
-    bg = user.get('profile_use_background_image', False) \
-         and user.get('profile_background_image_url', None)
-    if bg:
-        bg_rpc = urlfetch.create_rpc()
-        urlfetch.make_fetch_call(bg_rpc, bg)
-        logging.debug("Loading background from %r" % bg)
-    profile = user.get('profile_image_url', None)
-    if profile:
-        prof_rpc = urlfetch.create_rpc()
-        urlfetch.make_fetch_call(prof_rpc, profile)
-        logging.debug("Loading profile picture from %r" % profile)
-
-    words = text.split()
-    line_imgs = []
-
-    # Generate Google chart text boxes for all text, one for each line
-    # (I want to adjust the line height)
-
-    def _tweet_line(text, color="000000"):
-        return chart_img("http://chart.apis.google.com/chart?"
-                         "chst=d_text_outline&chld=%s|23|l|f7f7f7|_|%s"
-                         "&chf=bg,s,ffffff"
-                         % (color, quote(text.encode('utf-8'))))
-
-    MARGIN, PADDING, LINE = 50, 25, 30
-    MARGINF, PADDINGF, LINEF = map(float, (MARGIN, PADDING, LINE))
-
-    # Load background image to get dimensions
-
-    tmpl_data = open("tweet-bg.png", "rb").read()
-    tmpl = images.Image(tmpl_data)
-    t_width, t_height = tmpl.width, tmpl.height
+def _colored_words(text, entities):
+    """Splits `text` into `(word, color)`s, the colour being that of the
+    entity the word is part of, or None. Entity indices count code points."""
+    chars = [glyphs.unichr_(cp) for cp in glyphs.codepoints(text)]
+    colors = [None] * len(chars)
+    for kind, start, end in entities:
+        colors[start:end] = [ENTITY_COLORS.get(kind)] * len(colors[start:end])
+    words = []
+    for space, run in groupby(zip(chars, colors), lambda (c, _color): c.isspace()):
+        if not space:
+            run = list(run)
+            words.append(("".join(c for c, _color in run),
+                          first(color for _c, color in run if color)))
+    return words
+
+def _gen_shot(tweet_id, restore=False):
+    # The render is a graph of stages (see `pipeline`), each started as
+    # soon as the stages it needs are done:
+    #
+    #   tweet -> assets -> avatar
+    #   tweet -> footer
+    #   tweet, layout -> fit -> lines, card
+    #   assets, fit -> background
+    #   all of them -> composite
+    #
+    # So the footer texts and the avatar are made while the text is being
+    # fitted, and the lines, the card and the background at once after it.
+
+    MARGIN, PADDING, LINE = 50, chrome.PADDING, chrome.LINE
+
+    t_width, t_height = chrome.CHROME.size
 
     # This is just a white bar 4x30, to do fills
-    bar = open("bar.png", "rb").read()
-
-    while words:
-        logging.debug("Words left: %r" % words)
-        r = (1, len(words))
-        mid = r[1]
-        line_img = None
-
-        # Here we do a binary search to find how many of the words
-        # we can fit into one line.
-        while True:
-
-            logging.debug("Requesting [%d,%d,%d]" % (r[0], mid, r[1]))
-
-            line = None
-            try:
-                line = _tweet_line(" ".join(words[:mid]))
-            except ChartAPIException, e:
-                logging.debug(e, exc_info=1)
-                if e.response.status_code != 400:
-                    raise ServerError(500, "Chart API error %d" % e.response.status_code)
-                # Otherwise text was probably just too wide
+    bar = chrome.read("bar.png")
+
+    # 600px wide, 25px margin
+    max_line_width = t_width - 2 * PADDING
+    # The search counts are added to by the stages running in parallel
+    width_errors, search = [], {'round_trips': 0, 'requests': 0}
+    search_lock = Lock()
+    storing = []
 
-            # 600px wide, 25px margin
-            if not line or images.Image(line).width > t_width - 2 * PADDING:
-                r = (r[0], mid)
+    def _canvas_size(lines):
+        return t_width + 2 * MARGIN, t_height + 2 * MARGIN + (lines - 1) * LINE
+
+    def _tweet():
+        try:
+            tweet = tweets.get(tweet_id) or {}
+        except TwitterAPIError, e:
+            raise ServerError(502, str(e))
+        logging.debug("Got data: %r" % tweet)
+        if not tweet.get('text'):
+            raise ServerError(404, "No tweet text")
+        return tweet
+
+    def _assets(tweet):
+        # Downloads start right away
+        user = tweet.get('user') or {}
+        bg = user.get('profile_use_background_image', False) \
+             and user.get('profile_background_image_url', None)
+        profile = user.get('profile_image_url', None)
+        return (bg and assets.Asset(bg, "background"),
+                profile and assets.Asset(profile, "profile picture"))
+
+    def _measured_lines(backend, texts, color=None):
+        # Drawn in `color`, or without one just measured: `Fragment`s
+        # without images, for fitting
+        with metrics.span("chart"):
+            if color:
+                fragments, fetched = backend.text_imgs(texts, color)
             else:
-                r = (mid, r[1])
-                line_img = line
-
-            mid = max(1, r[0] + (r[1] - r[0]) / 2)
-            if r[0] == r[1] or mid == r[0] and line_img:
-                break
-
-        if not line_img:
-            # If still couldn't generate the line, try splitting first word
-            # into two parts. (Here we don't try to find the optimum..)
-            s = len(words[0]) / 2
-            if not s:
+                fragments, fetched = backend.text_widths(texts)
+                fragments = [width if isinstance(width, ChartAPIException)
+                             else Fragment(None, width) for width in fragments]
+        if fetched:
+            with search_lock:
+                search['round_trips'] += 1
+                search['requests'] += fetched
+        results = []
+        for text, fragment in zip(texts, fragments):
+            if isinstance(fragment, ChartAPIException):
+                logging.debug(fragment)
+                if fragment.response.status_code != 400:
+                    raise ServerError(500, "Chart API error %d"
+                                           % fragment.response.status_code)
+                # Otherwise text was probably just too wide
+                results.append(None)
+            else:
+                # The width model is of the Chart API font, local widths
+                # would only skew its error stats
+                if not color and isinstance(backend, typeset.ChartText):
+                    width_errors.append(glyphs.MODEL.observe(text, fragment.width))
+                results.append(fragment)
+        return results
+
+    def _fit(tweet, stored_layout):
+        # Some manual “Twitter-JSON” unquoting; entity indices count the
+        # unquoted text
+        text = reduce(lambda t, (p, s): t.replace(p, s),
+                      (("&gt;", ">"), ("&lt;", "<"), ("&amp;", "&")),
+                      tweet['text'])
+        if 'entities' in tweet:
+            words = _colored_words(text, tweet['entities'])
+        else:
+            words = [(w, first(c for p, c in COLOR_WORDS if p.match(w)))
+                     for w in text.split()]
+        # Need to escape pipes for chart API
+        words, word_colors = ([w.replace("|", u"\u05C0") for w, _c in words],
+                              [c for _w, c in words])
+
+        # Each line is laid out as its text and its coloured segments, runs
+        # of words drawn over it as `(color, offset, text)`, and the text
+        # backend drawing all of it. Fitting that is the expensive part, so
+        # the layout is stored for re-renders.
+        backends = typeset.chain()
+        layout_digest = layouts.digest(words, word_colors,
+                                       [backend.name for backend in backends],
+                                       settings.TEXT_FONT, max_line_width)
+        lines = layouts.LAYOUTS.match(stored_layout, layout_digest)
+        if lines is not None:
+            return lines
+
+        def _fit_line(backend):
+            # Find how many of the words we can fit into one line, starting
+            # from the locally predicted break
+            measure = lambda texts: _measured_lines(backend, texts)
+            mid, _img, _rounds = layout.fit_words(
+                words, max_line_width, measure, glyphs.MODEL.predict,
+                settings.LINE_SEARCH_FANOUT)
+            if mid:
+                return mid, None
+
+            # Even the first word is too wide (long URLs, unspaced CJK), so
+            # cut it after the last character that still fits
+            clusters = glyphs.graphemes(words[0])
+            cut, _img, _rounds = layout.fit_chars(
+                clusters, max_line_width, measure, glyphs.MODEL.predict,
+                settings.LINE_SEARCH_FANOUT)
+            if not cut:
                 raise ServerError(500, "Failed to process tweet :/")
-            words[0:1] = [words[0][:s], words[0][s:]]
-            continue
-
-        # Now that we have a good line, let's see if we need to apply
-        # some colors. This is freaking awful...
-        colors = [(w, first((c for p, c in COLOR_WORDS if p.match(w))))
-                  for w in words[:mid]]
-        colors = [(c, " ".join(w for w, _c in part))
-                   for c, part in groupby(colors, lambda (_w, c): c)]
-        if len(colors) > 1 or colors[0][0]:
-            offset = 0
-            composition = [(line_img, 0, 0, 1., images.TOP_LEFT)]
-            for i, (color, part) in enumerate(colors):
+            return 1, filter(None, ["".join(clusters[:cut]),
+                                    "".join(clusters[cut:])])
+
+        lines = []
+        while words:
+            logging.debug("Words left: %r" % words)
+
+            # The line is drawn by the first backend covering it. Ones
+            # before the last are local, so trying them first costs no
+            # remote calls; those not covering even the first word can't
+            # draw the line.
+            for backend in backends:
+                if backend is not backends[-1] and not backend.covers(words[0]):
+                    continue
+                mid, pieces = _fit_line(backend)
+                if backend.covers(pieces[0] if pieces else " ".join(words[:mid])):
+                    break
+            if pieces:
+                words[0:1] = pieces
+                word_colors[0:1] = word_colors[:1] * len(pieces)
+
+            # Coloured runs are offset by the width of the line before
+            # them. Those prefixes end at a word, so most were measured
+            # while fitting the line already.
+            segments, start = [], 0
+            for color, run in groupby(word_colors[:mid]):
+                count = len(list(run))
                 if color:
-                    part = _tweet_line(part, color)
-                    offset = 0
-                    before = " ".join(part for c, part in colors[:i])
-                    if before:
-                        offset = images.Image(_tweet_line(before)).width + 5
-                    part_w = images.Image(part).width
+                    segments.append((color, " ".join(words[:start]),
+                                     " ".join(words[start:start + count])))
+                start += count
+            befores = [before for _c, before, _t in segments if before]
+            prefixes = befores and dict(zip(befores,
+                                            _measured_lines(backend, befores))) or {}
+            for _c, before, text in segments:
+                if before and not prefixes[before]:
+                    raise ServerError(500, "Failed to color %r" % text)
+            lines.append((" ".join(words[:mid]),
+                          [(color, prefixes[before].width + 5 if before else 0, text)
+                           for color, before, text in segments],
+                          backend.name))
+
+            words, word_colors = words[mid:], word_colors[mid:]
+        storing.append(layouts.LAYOUTS.put(tweet_id, layout_digest, lines))
+        return lines
+
+    def _lines(lines):
+        # Lines fitted just now with the Chart API were rendered while
+        # fitting, local ones only measured; the lines of each backend go in
+        # one batch, and their coloured segments in one per colour, the
+        # batches at once
+        backends = dict((backend.name, backend) for backend in typeset.chain())
+        batches = {}
+        for line, segments, name in lines:
+            batches.setdefault((name, "000000"), set()).add(line)
+            for color, _o, text in segments:
+                batches.setdefault((name, color), set()).add(text)
+        batches = [(batch, list(texts)) for batch, texts in batches.items()]
+        fragments = pipeline.parallel(
+            *[(lambda batch=batch, texts=texts:
+                   _measured_lines(backends[batch[0]], texts, batch[1]))
+              for batch, texts in batches])
+        drawn = dict((batch, dict(zip(texts, batch_fragments)))
+                     for (batch, texts), batch_fragments in zip(batches, fragments))
+
+        line_imgs = []
+        for line, segments, name in lines:
+            fragment = drawn[name, "000000"][line]
+            if not fragment:
+                raise ServerError(500, "Failed to process tweet :/")
+            line_img = fragment.img
+            if segments:
+                composition = [(line_img, 0, 0, 1., images.TOP_LEFT)]
+                for color, offset, text in segments:
+                    part = drawn[name, color][text]
+                    if not part:
+                        raise ServerError(500, "Failed to color %r" % text)
                     composition += [(bar, offset - 3, 0, 1., images.TOP_LEFT),
-                                    (bar, offset + part_w - 1, 0, 1., images.TOP_LEFT),
-                                    (part, offset, 0, 1., images.TOP_LEFT)]
-
-            # Re-compose line
-            line_img = images.composite(composition, t_width - PADDING, LINE, 0xffffffff)
-
-        line_imgs.append(line_img)
-
-        words = words[mid:]
-
-    # Generate date string
-
-    # Sun Jul 20 20:09:30 +0000 2014
-    created = datetime.strptime(tweet['created_at'], "%a %b %d %H:%M:%S +0000 %Y")
-    created.replace(tzinfo=CTzinfo())
-    created = filter(lambda s: s,
-                     (created.strftime(fmt).lstrip("0")
-                      for fmt in ("%a %b", "%d", "%I:%M%p %Y", "%Z")))
-    created_str = " ".join(created)
-    source = tweet.get('source')
-    if source:
-        # Yea, can't re HTML but let's try
-        source = re.sub(r"<[^>]*>", "", source)
-        created_str += " via %s" % source
-    place = tweet.get('place')
-    place = place and place.get('full_name')
-    if place:
-        created_str += " from %s" % place
-    reply_to = tweet.get('in_reply_to_screen_name')
-    if reply_to:
-        created_str += " in reply to %s" % reply_to
-
-    # Generate some more charts...
-    created = chart_img("http://chart.apis.google.com/chart?"
-                        "chst=d_text_outline&chld=a0a0a0|10|l|ffffff|_|%s"
-                        "&chf=bg,s,ffffff" % quote(created_str.encode('utf-8')))
-
-    screen_name = user.get('screen_name', "")
-    screen_name_img = chart_img("http://chart.apis.google.com/chart?"
-                                "chst=d_text_outline&chld=0000ff|24|l|ffffff|_|%s"
-                                "&chf=bg,s,ffffff" % quote(screen_name.encode('utf-8')))
-
-    name, name_img = user.get('name', ""), None
-    if name and name != screen_name:
-        name_img = chart_img("http://chart.apis.google.com/chart?"
-                             "chst=d_text_outline&chld=000000|13|l|ffffff|_|%s"
-                             "&chf=bg,s,ffffff" % quote(name.encode('utf-8')))
-
-    # Start generating the actual tweetshot
-
-    lines = len(line_imgs)
-
-    width, height = t_width + 2 * MARGIN, t_height + 2 * MARGIN + (lines - 1) * LINE
-
-    # Damn the rounded corners; need to seriously slice and re-compose
-
-    px3 = 3. / t_width
-    top1 = images.crop(tmpl_data,
-                       px3,
-                       0.,
-                       1. - px3,
-                       PADDINGF / t_height)
-    top2 = images.crop(tmpl_data,
-                       0.,
-                       3. / t_height,
-                       1.,
-                       PADDINGF / t_height)
-
-    line_bg = images.crop(tmpl_data, 0., PADDINGF / t_height, 1., (PADDINGF + LINE) / t_height)
-
-    bottom1 = images.crop(tmpl_data,
-                          px3,
-                          (PADDINGF + LINE) / t_height,
-                          1 - px3,
-                          1.)
-    bottom2 = images.crop(tmpl_data,
-                          0.,
-                          (PADDINGF + LINE) / t_height,
-                          1.,
-                          1 - 3. / t_height)
-
-    # Okay, let's start composing the image
-
-    # Layout background to bottom
-
-    components = []
-
-    bg_rs = bg_rpc and bg_rpc.get_result()
-    if bg_rs:
-        if bg_rs.status_code == 200:
-            bg_img = images.Image(bg_rs.content)
-            components += [(bg_rs.content, x, y, 1., images.TOP_LEFT)
-                           for x in range(0, width, bg_img.width)
-                           for y in range(0, height, bg_img.height)]
-        else:
-            logging.warning("Background download failed %d: %r"
-                            % (bg_rs.status_code, bg_rs.content))
-
-    # Then add tweet box and texts
-
-    footer_y = MARGIN + PADDING + lines * LINE
-
-    components += [(top1, MARGIN + 3, MARGIN, 1., images.TOP_LEFT),
-                   (top2, MARGIN, MARGIN + 3, 1., images.TOP_LEFT)] \
-                  + [(line_bg, MARGIN, MARGIN + PADDING + n * LINE, 1., images.TOP_LEFT)
-                     for n in range(len(line_imgs))] \
-                  + [(bottom1, MARGIN + 3, footer_y, 1., images.TOP_LEFT),
-                     (bottom2, MARGIN, footer_y, 1., images.TOP_LEFT)] \
-                  + [(line, MARGIN + PADDING, MARGIN + PADDING + n * LINE, 1., images.TOP_LEFT)
-                     for n, line in enumerate(line_imgs)] \
-                  + [(created, MARGIN + PADDING, footer_y + 3, 1., images.TOP_LEFT),
-                     (screen_name_img, MARGIN + PADDING + 48 + 20, footer_y + 49, 1., images.TOP_LEFT)]
-
-    if name_img:
-        components.append((name_img, MARGIN + PADDING + 48 + 20, footer_y + 49 + 26, 1., images.TOP_LEFT))
-
-    # Add profile picture
-
-    prof_rs = prof_rpc and prof_rpc.get_result()
-    prof_pic = None
-    if prof_rs:
-        if prof_rs.status_code == 200:
-            prof_pic = images.Image(prof_rs.content)
-            if not (prof_pic.width == prof_pic.height == 48):
-                prof_pic = images.resize(prof_rs.content, 48, 48)
-            components.append((prof_pic, MARGIN + PADDING, footer_y + 48, 1., images.TOP_LEFT))
-        else:
-            logging.warning("Profile picture download failed %d: %r"
-                            % (prof_rs.status_code, prof_rs.content))
-
-    pix = open("pix.png", "rb").read()
+                                    (bar, offset + part.width - 1, 0, 1., images.TOP_LEFT),
+                                    (part.img, offset, 0, 1., images.TOP_LEFT)]
 
-    def _corners():
-        yield (lambda x: MARGIN + x), (lambda y: MARGIN + y)
-        yield (lambda x: width - MARGIN - x - 1), (lambda y: MARGIN + y)
-        yield (lambda x: MARGIN + x), (lambda y: height - MARGIN - y - 1)
-        yield (lambda x: width - MARGIN - x - 1), (lambda y: height - MARGIN - y - 1)
+                # Re-compose line
+                line_img = COMPOSITOR.composite(composition, t_width - PADDING, LINE, 0xffffffff)
 
-    # Insert magic corner dust
-    components += reduce(lambda pixies, (fx, fy):
-                             pixies + [(pix, fx(x), fy(y), a, images.TOP_LEFT)
-                                       for x, y, a in ((1, 1, .8), (2, 0, .5), (0, 2, .5),
-                                                       (2, 1, 1.), (2, 2, 1.), (1, 2, 1.))],
-                         _corners(),
-                         [])
-
-    # Would be nice if this applied for transparent background images as well,
-    # but images.composite doesn't merge pixels, it just overwrites with
-    # zero-alphas
-    bg_color = 0xff000000 + int(user.get('profile_background_color') or "0", 16)
-
-    tweetshot = components.pop(0)
-    while components:
-        batch, components = components[:15], components[15:]
-        tweetshot = (images.composite([tweetshot] + batch, width, height, bg_color),
-                     0, 0, 1., images.TOP_LEFT)
-
-    return tweetshot[0]
+            line_imgs.append(line_img)
+        return line_imgs
+
+    def _footer(tweet):
+        user = tweet.get('user') or {}
+
+        # Generate date string
+
+        # Sun Jul 20 20:09:30 +0000 2014
+        created = datetime.strptime(tweet['created_at'], "%a %b %d %H:%M:%S +0000 %Y")
+        created.replace(tzinfo=CTzinfo())
+        created = filter(lambda s: s,
+                         (created.strftime(fmt).lstrip("0")
+                          for fmt in ("%a %b", "%d", "%I:%M%p %Y", "%Z")))
+        created_str = " ".join(created)
+        source = tweet.get('source')
+        if source:
+            # Yea, can't re HTML but let's try
+            source = re.sub(r"<[^>]*>", "", source)
+            created_str += " via %s" % source
+        place = tweet.get('place')
+        place = place and place.get('full_name')
+        if place:
+            created_str += " from %s" % place
+        reply_to = tweet.get('in_reply_to_screen_name')
+        if reply_to:
+            created_str += " in reply to %s" % reply_to
+
+        # Generate some more charts...
+        screen_name, name = user.get('screen_name', ""), user.get('name', "")
+        calls = [lambda: typeset.text_img(created_str, "a0a0a0", 10, "ffffff").img,
+                 lambda: typeset.text_img(screen_name, "0000ff", 24, "ffffff").img]
+        if name and name != screen_name:
+            calls.append(lambda: typeset.text_img(name, "000000", 13, "ffffff").img)
+        return (pipeline.parallel(*calls) + [None])[:3]
+
+    def _background((bg_asset, _prof_asset), lines):
+        return bg_asset and bg_asset.tiled(*_canvas_size(len(lines)))
+
+    def _avatar((_bg_asset, prof_asset)):
+        return prof_asset and prof_asset.avatar(48)
+
+    def _composite(tweet, line_imgs, card, bg_img, footer, prof_pic):
+        created, screen_name_img, name_img = footer
+
+        # Start generating the actual tweetshot
+
+        lines = len(line_imgs)
+
+        width, height = _canvas_size(lines)
+
+        # Okay, let's start composing the image
+
+        # Layout background to bottom
+
+        background = []
+
+        if bg_img:
+            background.append((bg_img, 0, 0, 1., images.TOP_LEFT))
+
+        # Then add tweet box and texts
+
+        footer_y = MARGIN + PADDING + lines * LINE
+
+        # The empty card, corners and all, is precomposed per line count, and
+        # by whether the compositor blends: one falling back to the images
+        # API gets the opaque card
+        def _card(blends):
+            layers = card if blends == COMPOSITOR.blends \
+                else chrome.CHROME.card(lines, blends)
+            return [(img, MARGIN + x, MARGIN + y, opacity, anchor)
+                    for img, x, y, opacity, anchor in layers]
+
+        texts = [(line, MARGIN + PADDING, MARGIN + PADDING + n * LINE, 1., images.TOP_LEFT)
+                 for n, line in enumerate(line_imgs)] \
+                + [(created, MARGIN + PADDING, footer_y + 3, 1., images.TOP_LEFT),
+                   (screen_name_img, MARGIN + PADDING + 48 + 20, footer_y + 49, 1., images.TOP_LEFT)]
+
+        if name_img:
+            texts.append((name_img, MARGIN + PADDING + 48 + 20, footer_y + 49 + 26, 1., images.TOP_LEFT))
+
+        # Add profile picture
+
+        if prof_pic:
+            texts.append((prof_pic, MARGIN + PADDING, footer_y + 48, 1., images.TOP_LEFT))
+
+        # With the images API compositor this doesn't apply for transparent
+        # background images, images.composite doesn't merge pixels, it just
+        # overwrites with zero-alphas
+        user = tweet.get('user') or {}
+        bg_color = 0xff000000 + int(user.get('profile_background_color') or "0", 16)
+
+        return COMPOSITOR.composite(
+            lambda blends: background + _card(blends) + texts,
+            width, height, bg_color)
+
+    graph = pipeline.Graph()
+    graph.add("tweet", _tweet)
+    # A stored layout is loaded alongside the tweet; from the fallback
+    # store only when `restore`-ing the layout of a tweet rendered before
+    graph.add("layout", lambda: layouts.LAYOUTS.load(tweet_id, restore))
+    graph.add("assets", _assets, "tweet")
+    graph.add("avatar", _avatar, "assets")
+    graph.add("footer", _footer, "tweet")
+    graph.add("fit", _fit, "tweet", "layout")
+    graph.add("card", lambda lines: chrome.CHROME.card(len(lines)), "fit")
+    graph.add("lines", _lines, "fit")
+    graph.add("background", _background, "assets", "fit")
+    graph.add("composite", _composite,
+              "tweet", "lines", "card", "background", "footer", "avatar")
+    try:
+        shot = graph.result("composite")
+    finally:
+        # Nothing outlives the request, even after a failure. The layout
+        # fitted is stored while the lines are drawn and composited.
+        graph.wait()
+        for wait in storing:
+            wait()
+
+    logging.info("%d lines in %d chart round trips (%d requests)"
+                 % (len(graph.result("lines")), search['round_trips'],
+                    search['requests']))
+    if width_errors:
+        logging.info("Width prediction error mean %.1fpx, max %.1fpx"
+                     % (sum(width_errors) / len(width_errors),
+                        max(width_errors, key=abs)))
+    path = graph.critical_path("composite")
+    ms = (path[-1].finished - graph.started) * 1000
+    metrics.critical_path([task.name for task in path], ms)
+    logging.info("Critical path %.0fms: %s" % (ms, ", ".join(
+        "%s %.0fms" % (task.name, task.ms) for task in path)))
+    return shot
 
 
 class AuthHandler(webapp.RequestHandler):
@@ -366,6 +452,56 @@ class CallbackHandler(webapp.RequestHandler):
         logging.debug("user_info: %r" % (user_info,))
 
 
+class WarmupHandler(webapp.RequestHandler):
+    def get(self):
+        chrome.CHROME.warm()
+        banners.warm()
+
+
+RENDERS = SingleFlight()
+
+FAILED_KEY = "failed:%s"
+
+def _status(exc):
+    return exc.status if isinstance(exc, ServerError) else 500
+
+def _render(tweet_id, restore=False):
+    """Renders and stores `tweet_id`. Concurrent renders of the same tweet
+    share one. Returns the stored `Shot`s by width. `restore` if it was
+    rendered before, to look for its layout in the fallback store too.
+
+    A failure is remembered for a while, by its status (see
+    `settings.FAILURE_TTLS`), and raised again without another try."""
+    def _stored():
+        # Polled while another render is on, so not counted
+        full = shots.get(tweet_id, count=False)
+        return full and not shots.stale(full) and {None: full}
+
+    failed = memcache.get(FAILED_KEY % tweet_id)
+    if failed:
+        metrics.count("failures_remembered")
+        raise ServerError(*failed)
+    try:
+        return RENDERS.do(tweet_id,
+                          lambda: shots.put(tweet_id, _gen_shot(int(tweet_id),
+                                                                restore)),
+                          _stored)
+    except (ServerError, ChartAPIException, images.BadImageError), e:
+        status = _status(e)
+        memcache.set(FAILED_KEY % tweet_id, (status, e.message or str(e)),
+                     time=settings.FAILURE_TTLS.get(status, 60))
+        raise
+
+# Refreshes re-render stale shots, so there may be a stored layout
+REFRESHER = Refresher(lambda tweet_id: _render(tweet_id, restore=True))
+
+
+class RefreshHandler(webapp.RequestHandler):
+    """Task queue worker re-rendering stale shots."""
+    def post(self):
+        REFRESHER.run(self.request.get('id'))
+
+
 class TweetHandler(webapp.RequestHandler):
 
     def error_msg(self, code, msg):
@@ -373,61 +509,141 @@ class TweetHandler(webapp.RequestHandler):
         self.response.out.write(msg)
 
     def get(self, tweet_id, width=None):
-        img = memcache.get(tweet_id)
-        if not img:
-            img = _gen_shot(int(tweet_id))
-            memcache.set(tweet_id, img, time=24 * 60 * 60)
-
-        if width:
-            # Not memcaching these, Google's proxy cache *should* handle.
-            # (Waiting for it to kick in; the basic memcaching is there just
-            # because it's not working.)
-            width = min(max(int(width), 300), images.Image(img).width)
-            img = images.resize(img, width)
-
-        self.response.headers['Content-Type'] = "image/png"
-        self.response.headers['Cache-Control'] = "public, max-age=%d" % (24 * 60 * 60)
+        width = shots.clamp(None if width is None else int(width))
+        fmt = formats.negotiate(self.request.headers.get('Accept'))
+        variant = width or fmt != formats.DEFAULT
+        metrics.start()
+        with metrics.span("cache"):
+            shot = shots.get(tweet_id, width, fmt)
+        full = None
+        if shot and variant and shots.stale(shot):
+            # The full size may have been refreshed since the variant
+            full = shots.get(tweet_id)
+            if full and full.rendered > shot.rendered:
+                shot = None
+        if not shot:
+            full = full or variant and shots.get(tweet_id)
+            if not full:
+                try:
+                    with metrics.span("render"):
+                        rendered = _render(tweet_id)
+                except RateLimited, e:
+                    self.rate_limited(tweet_id, width, fmt, e)
+                    return
+                full = rendered[None]
+                if fmt == formats.DEFAULT:
+                    shot = rendered.get(width)
+            if not shot:
+                with metrics.span("variant"):
+                    shot = shots.variant(tweet_id, full, width, fmt)
+        if shots.stale(shot):
+            # Serve it anyway, a fresh one is on its way
+            REFRESHER.queue(tweet_id)
+
+        self.response.headers['Content-Type'] = formats.CONTENT_TYPES[fmt]
+        self.response.headers['Vary'] = "Accept"
+        self.response.headers['Cache-Control'] = "public, max-age=%d" % shots.max_age(shot)
+        self.response.headers['ETag'] = shot.etag
+        if shots.matches(self.request.headers.get('If-None-Match'), shot.etag):
+            self.response.set_status(304)
+        else:
+            metrics.count("response_bytes", len(shot.img))
+            self.response.out.write(shot.img)
+        self.response.headers['Server-Timing'] = metrics.server_timing(metrics.finish())
+
+    def rate_limited(self, tweet_id, width, fmt, exc):
+        """Makes do without the Twitter API until its limit resets: serves
+        any earlier image of the tweet, or else the placeholder."""
+        logging.warning(exc)
+        metrics.count("rate_limited")
+        shot, fmt = shots.last_good(tweet_id, width, fmt)
+        if shot:
+            self.response.headers['Content-Type'] = formats.CONTENT_TYPES[fmt]
+            self.response.headers['ETag'] = shot.etag
+            img = shot.img
+        else:
+            self.response.set_status(503)
+            self.response.headers['Content-Type'] = "image/png"
+            self.response.headers['Retry-After'] = str(exc.retry_after())
+            img = PLACEHOLDER
+        self.response.headers['Vary'] = "Accept"
+        self.response.headers['Cache-Control'] = "public, max-age=%d" % exc.retry_after()
+        metrics.count("response_bytes", len(img))
         self.response.out.write(img)
+        self.response.headers['Server-Timing'] = metrics.server_timing(metrics.finish())
 
     def handle_exception(self, exc, debug_mode):
         if isinstance(exc, (ServerError, ChartAPIException, images.BadImageError)):
             logging.warning(exc, exc_info=1)
-            msg = "Tweetpong: %s" % (exc.message or "Failed to process tweet :(")
-            self.redirect("http://chart.apis.google.com/chart?"
-                          "chst=d_text_outline&chld=a00000|13|l|ffffff|_|%s"
-                          "&chf=bg,s,ffffff" % quote(msg.encode('utf-8')))
         else:
             logging.exception(exc)
-            self.redirect("http://chart.apis.google.com/chart?"
-                          "chst=d_text_outline&chld=a00000|13|l|ffffff|_|%s"
-                          "&chf=bg,s,ffffff" % "Tweetpong: Failed to process tweet ):")
+        status = _status(exc)
+        banner = banners.get(status)
+        self.response.set_status(status)
+        self.response.headers['Content-Type'] = "image/png"
+        self.response.headers['Cache-Control'] = "public, max-age=%d" \
+            % settings.FAILURE_TTLS.get(status, 60)
+        metrics.count("response_bytes", len(banner))
+        self.response.out.write(banner)
+        trace = metrics.finish()
+        if trace is not None:
+            self.response.headers['Server-Timing'] = metrics.server_timing(trace)
+
+
+class StatsHandler(webapp.RequestHandler):
+    """Timings and counters of this instance, for admins."""
+    def get(self):
+        stats = metrics.stats()
+        stats['components'] = {
+            'renders': RENDERS.stats(),
+            'refreshes': REFRESHER.stats(),
+            'random_pool': randompool.POOL.stats(),
+            'shots': shots.STORE.stats(),
+            'shot_tiers': shots.stats(),
+            'formats': formats.stats(),
+            'fragments': charts.FRAGMENTS.stats(),
+            'tweet_lookups': tweets.BATCHER.stats(),
+            'rate_limits': ratelimit.LIMITS.stats(),
+            'twitter_connections': twitter.CLIENT.stats(),
+            'asset_urls': assets.DIGESTS.stats(),
+            'assets': assets.CONTENT.stats(),
+            'width_model': glyphs.MODEL.stats(),
+            'layouts': layouts.LAYOUTS.stats(),
+        }
+        self.response.headers['Content-Type'] = "application/json"
+        self.response.headers['Cache-Control'] = "no-store"
+        self.response.out.write(json.dumps(stats, indent=2, sort_keys=True))
 
 
 class RandomHandler(TweetHandler):
-    """Returns full tweet data as JSON from a random tweet of the one billion
-    latest tweets."""
+    """Returns the data of a random recent tweet as JSON, from the pool of
+    `randompool`."""
     def get(self):
-        max_id = memcache.get('max-tweet')
-        if max_id is None:
-            # Returns unauthorized, stupid API
-#            tweets = _make_twitter_request("https://stream.twitter.com/1/statuses/firehose.json?count=1")
-            tweets_rs = _make_twitter_request("https://api.twitter.com/1.1/statuses/public_timeline.json?trim_user=1&include_entities=0&count=1")
-            if tweets_rs.status_code != 200:
-                self.error_msg(500, "Twitter API error")
-                return
-            max_id = json.loads(tweets_rs.content)[0]['id']
-            memcache.set('max-tweet', max_id, time=10 * 60)
-
-        tweet = None
-        while tweet == None:
-            tweet_id = randint(max_id - 10**9, max_id)
-            tweet_rs = _make_twitter_request("https://api.twitter.com/1.1/statuses/show/%d.json" % tweet_id)
-            if tweet_rs.status_code == 200:
-                tweet = tweet_rs.content
+        tweet = randompool.POOL.get()
+        if tweet is None:
+            self.error_msg(503, "No random tweets at hand, try again soon")
+            return
 
         self.response.headers['Content-Type'] = "text/javascript"
         self.response.headers['Cache-Control'] = "no-store"
-        self.response.out.write(tweet)
+        # Ids don't fit in JavaScript numbers
+        self.response.out.write(json.dumps(dict(tweet, id_str=str(tweet['id']))))
+
+
+class PurgeHandler(webapp.RequestHandler):
+    """Cron job deleting expired shots and layouts from the fallback
+    store."""
+    def get(self):
+        fallback = store.fallback()
+        if fallback:
+            logging.info("Purged %d expired values from %s"
+                         % (fallback.purge(), fallback.name))
+
+
+class RandomRefillHandler(webapp.RequestHandler):
+    """Task queue worker refilling the random tweet pool."""
+    def post(self):
+        randompool.POOL.refill()
 
 
 app = webapp.WSGIApplication([
@@ -436,4 +652,9 @@ app = webapp.WSGIApplication([
         (r"^/auth/$", AuthHandler),
         (r"^/callback/$", CallbackHandler),
         (r"^/random/$", RandomHandler),
+        (r"^/_ah/warmup$", WarmupHandler),
+        (r"^/tasks/refresh$", RefreshHandler),
+        (r"^/tasks/random-refill$", RandomRefillHandler),
+        (r"^/tasks/purge-store$", PurgeHandler),
+        (r"^/stats/$", StatsHandler),
     ], debug=True)
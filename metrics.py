@@ -0,0 +1,149 @@
+"""Lightweight render instrumentation.
+
+A request starts a trace; `span` times a stage of it and `count` adds to a
+counter of it (Chart API calls, composite passes, bytes). The trace of a
+request goes out in its Server-Timing header, and every span and counter
+is also collected in per-instance histograms of the latest samples, served
+by /stats/. Spans and counts outside a request (background refreshes) only
+go to the histograms. Stages run on other threads (see `pipeline`) attach
+to the trace of their request; `critical_path` records which of them the
+request waited for.
+"""
+
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from threading import local, Lock
+import time
+
+
+# Samples kept per histogram
+SAMPLES = 1000
+
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram(object):
+    """The latest `size` samples of a value, for percentiles."""
+
+    def __init__(self, size=SAMPLES):
+        self._samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        self._samples.append(value)
+        self.count += 1
+
+    def stats(self):
+        samples = sorted(self._samples)
+        if not samples:
+            return {'count': 0}
+        stats = dict(("p%d" % p, samples[min(len(samples) * p / 100,
+                                             len(samples) - 1)])
+                     for p in PERCENTILES)
+        stats.update(count=self.count, max=samples[-1],
+                     mean=sum(samples) / float(len(samples)))
+        return stats
+
+
+class Trace(object):
+    def __init__(self):
+        self.started = time.time()
+        self.spans, self.counters = OrderedDict(), OrderedDict()
+        self.path = None
+
+
+_local = local()
+_lock = Lock()
+_timings, _counts, _totals = {}, {}, {}
+# How often each stage was on the critical path
+_path_counts = {}
+
+
+def _add(histograms, name, value):
+    with _lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(value)
+
+
+def start():
+    """Starts the trace of the current request."""
+    _local.trace = Trace()
+    return _local.trace
+
+def current():
+    return getattr(_local, 'trace', None)
+
+def attach(trace):
+    """Makes `trace` that of the current thread, or none."""
+    _local.trace = trace
+
+def finish():
+    """Ends the current trace and records its total time and counters.
+    Returns it."""
+    trace, _local.trace = current(), None
+    if trace is not None:
+        trace.spans['total'] = (time.time() - trace.started) * 1000
+        _add(_timings, 'total', trace.spans['total'])
+        for name, value in trace.counters.items():
+            _add(_counts, name, value)
+    return trace
+
+@contextmanager
+def span(name):
+    """Times the enclosed stage as `name`. Repeated stages add up."""
+    started = time.time()
+    try:
+        yield
+    finally:
+        ms = (time.time() - started) * 1000
+        _add(_timings, name, ms)
+        trace = current()
+        if trace is not None:
+            with _lock:
+                trace.spans[name] = trace.spans.get(name, 0) + ms
+
+def count(name, n=1):
+    """Adds `n` to counter `name`."""
+    with _lock:
+        _totals[name] = _totals.get(name, 0) + n
+        trace = current()
+        if trace is not None:
+            trace.counters[name] = trace.counters.get(name, 0) + n
+
+def critical_path(stages, ms):
+    """Records that the current request waited `ms` for the chain of
+    `stages` (names), which ran one after the other."""
+    _add(_timings, 'critical_path', ms)
+    with _lock:
+        for stage in stages:
+            _path_counts[stage] = _path_counts.get(stage, 0) + 1
+    trace = current()
+    if trace is not None:
+        trace.path = (list(stages), ms)
+
+
+def server_timing(trace):
+    """Server-Timing header value of `trace`: spans with their durations,
+    counters with their values as descriptions, and the critical path with
+    its stages."""
+    return ", ".join(["%s;dur=%.1f" % (name, ms)
+                      for name, ms in trace.spans.items()]
+                     + ['%s;desc="%d"' % (name, value)
+                        for name, value in trace.counters.items()]
+                     + (['critical;dur=%.1f;desc="%s"'
+                         % (trace.path[1], ">".join(trace.path[0]))]
+                        if trace.path else []))
+
+
+def stats():
+    with _lock:
+        return {
+            'timings_ms': dict((name, histogram.stats())
+                               for name, histogram in _timings.items()),
+            'per_request': dict((name, histogram.stats())
+                                for name, histogram in _counts.items()),
+            'totals': dict(_totals),
+            'critical_path': dict(_path_counts),
+        }
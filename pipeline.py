@@ -0,0 +1,110 @@
+"""Dependency graphs of render stages, run as soon as their inputs exist.
+
+A render is mostly waiting on remote calls (Twitter, the Chart API, the
+images API, asset downloads), and most of them don't depend on each
+other: the footer texts only need the tweet, the background only the
+tweet and the canvas size. A `Graph` runs each task on its own thread once
+the tasks it depends on are done, so a render takes about as long as its
+longest chain of dependent calls rather than the sum of all of them.
+
+Tasks run in the metrics trace and with the rate limit priority of the
+thread that made the graph, each in a `metrics.span` of its name. When a
+task fails, the tasks depending on it fail with the same exception
+without running. `critical_path` tells which chain of tasks the render
+waited for.
+"""
+
+from collections import OrderedDict
+import sys
+from threading import Event, Thread
+import time
+
+import metrics
+import ratelimit
+
+
+class Task(object):
+    """A call of `fn` with the results of `deps`."""
+
+    def __init__(self, name, fn, deps):
+        self.name, self.fn, self.deps = name, fn, deps
+        self.done = Event()
+        self.value = self.error = None
+        self.started = self.finished = None
+
+    def result(self):
+        """Waits for the task and returns its value, or raises its
+        exception."""
+        self.done.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+    @property
+    def ms(self):
+        return (self.finished - self.started) * 1000
+
+
+class Graph(object):
+    """Tasks by name. With `spans`, each is timed in a metrics span."""
+
+    def __init__(self, spans=True):
+        self.spans = spans
+        self.tasks = OrderedDict()
+        self.started = time.time()
+        self._trace, self._priority = metrics.current(), ratelimit.current()
+
+    def add(self, name, fn, *deps):
+        """Runs `fn(*results of deps)` as task `name` once the tasks named
+        `deps` are done. Returns the task."""
+        task = self.tasks[name] = Task(name, fn, [self.tasks[d] for d in deps])
+        thread = Thread(target=self._run, args=(task,),
+                        name="%s-%s" % (name, id(self)))
+        thread.daemon = True
+        thread.start()
+        return task
+
+    def _run(self, task):
+        metrics.attach(self._trace)
+        try:
+            with ratelimit.priority(self._priority):
+                args = [dep.result() for dep in task.deps]
+                task.started = time.time()
+                if self.spans:
+                    with metrics.span(task.name):
+                        task.value = task.fn(*args)
+                else:
+                    task.value = task.fn(*args)
+        except Exception:
+            task.error = sys.exc_info()
+        finally:
+            task.started = task.started or time.time()
+            task.finished = time.time()
+            metrics.attach(None)
+            task.done.set()
+
+    def result(self, name):
+        return self.tasks[name].result()
+
+    def wait(self):
+        """Waits for all the tasks, failed or not."""
+        for task in self.tasks.values():
+            task.done.wait()
+
+    def critical_path(self, name):
+        """The chain of tasks that task `name` waited for, first to last,
+        each the dependency that finished last."""
+        task, path = self.tasks[name], []
+        task.done.wait()
+        while task:
+            path.insert(0, task)
+            task = max(task.deps, key=lambda dep: dep.finished) \
+                if task.deps else None
+        return path
+
+
+def parallel(*calls):
+    """Makes `calls` at once. Returns their results in order."""
+    graph = Graph(spans=False)
+    tasks = [graph.add(n, call) for n, call in enumerate(calls)]
+    return [task.result() for task in tasks]
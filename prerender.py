@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""Warms the cache: renders tweets ahead of the readers.
+
+Reads tweet ids, or tweet URLs, one per line from the files given or
+stdin. Tweets are looked up `twitter.LOOKUP_MAX` at a time, waiting out
+the rate limit when it runs out (with background priority, by default, so
+live requests keep their reserve; see `ratelimit`). Then they're rendered
+on a pool of threads or processes, into the same keys `TweetHandler`
+reads. Tweets already rendered and fresh are skipped, unless --force.
+
+The App Engine APIs are those of the app at --server, through remote_api
+(enabled in app.yaml); the App Engine SDK has to be importable:
+
+    python prerender.py [--threads 8 | --processes 4] [--force] [FILE ...]
+"""
+
+import argparse
+import fileinput
+import logging
+import os
+import re
+import sys
+import time
+
+
+STATUS_URL = re.compile(r"/status(?:es)?/(\d+)")
+ID = re.compile(r"^(\d+)$")
+
+# Tweets per progress report
+PROGRESS = 10
+
+
+def parse_ids(lines):
+    """Tweet ids of `lines`, in order and without duplicates."""
+    ids, seen = [], set()
+    for line in lines:
+        match = STATUS_URL.search(line) or ID.match(line.strip())
+        if not match:
+            if line.strip():
+                logging.warning("Not a tweet: %r" % line.strip())
+            continue
+        tweet_id = int(match.group(1))
+        if tweet_id not in seen:
+            seen.add(tweet_id)
+            ids.append(tweet_id)
+    return ids
+
+
+def configure(server):
+    """Points the App Engine APIs at the app on `server`."""
+    try:
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    except ImportError:
+        pass
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(server, "/_ah/remote_api")
+    os.environ.setdefault('SERVER_NAME', server)
+
+
+def lookup(ids, priority):
+    """Looks up and caches `ids`, waiting out rate limits. Returns the ids
+    of the tweets that exist."""
+    import ratelimit
+    import tweets
+    import twitter
+
+    found = set()
+    with ratelimit.priority(priority):
+        for start in range(0, len(ids), twitter.LOOKUP_MAX):
+            batch = ids[start:start + twitter.LOOKUP_MAX]
+            while True:
+                try:
+                    found.update(tweets.get_multi(batch))
+                    break
+                except ratelimit.RateLimited, e:
+                    print >>sys.stderr, "%s, waiting" % e
+                    time.sleep(e.retry_after())
+    return [tweet_id for tweet_id in ids if tweet_id in found]
+
+
+def render(args):
+    """Renders one tweet. Returns `(tweet_id, outcome, ms)`."""
+    tweet_id, force, priority = args
+    import main
+    import ratelimit
+    import shots
+
+    started = time.time()
+    try:
+        with ratelimit.priority(priority):
+            if force:
+                shots.put(tweet_id, main._gen_shot(tweet_id))
+                outcome = "rendered"
+            else:
+                full = shots.get(tweet_id, count=False)
+                if full and not shots.stale(full):
+                    outcome = "fresh"
+                else:
+                    main._render(str(tweet_id))
+                    outcome = "rendered"
+    except Exception, e:
+        logging.warning("Rendering %s failed: %s" % (tweet_id, e))
+        outcome = "failed"
+    return tweet_id, outcome, (time.time() - started) * 1000
+
+
+def run(ids, workers=4, processes=False, force=False, priority=None,
+        server=None):
+    """Prerenders `ids` on `workers` threads, or processes. Returns the
+    outcome counts and timings."""
+    from multiprocessing import Pool
+    from multiprocessing.pool import ThreadPool
+    import metrics
+    import ratelimit
+
+    priority = ratelimit.BACKGROUND if priority is None else priority
+    started = time.time()
+    found = lookup(ids, priority)
+    looked_up = time.time()
+    print >>sys.stderr, "%d of %d tweets found in %.1fs" % (
+        len(found), len(ids), looked_up - started)
+
+    if processes:
+        pool = Pool(workers, configure if server else None,
+                    (server,) if server else ())
+    else:
+        pool = ThreadPool(workers)
+    counts = {'missing': len(ids) - len(found)}
+    timings = []
+    try:
+        jobs = [(tweet_id, force, priority) for tweet_id in found]
+        for n, (tweet_id, outcome, ms) in enumerate(
+                pool.imap_unordered(render, jobs), 1):
+            counts[outcome] = counts.get(outcome, 0) + 1
+            if outcome == "rendered":
+                timings.append(ms)
+            if n % PROGRESS == 0 or n == len(jobs):
+                elapsed = time.time() - looked_up
+                print >>sys.stderr, "%d/%d done, %.1f/s, %s" % (
+                    n, len(jobs), n / elapsed, ", ".join(
+                        "%d %s" % (count, outcome)
+                        for outcome, count in sorted(counts.items())))
+    finally:
+        pool.close()
+        pool.join()
+
+    histogram = metrics.Histogram()
+    for ms in timings:
+        histogram.add(ms)
+    rendering = time.time() - looked_up
+    return {
+        'tweets': len(ids),
+        'outcomes': counts,
+        'lookup_s': looked_up - started,
+        'render_s': rendering,
+        'renders_per_s': len(timings) / rendering if rendering else 0,
+        'render_ms': histogram.stats(),
+        # Counted in this process only, which is all of them with threads
+        'totals': metrics.stats()['totals'],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("files", nargs="*", help="tweet ids or URLs, one per "
+                                                 "line (default: stdin)")
+    parser.add_argument("--server", default="tweetpng.appspot.com",
+                        help="the app to render for")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="render on this many threads")
+    parser.add_argument("--processes", type=int,
+                        help="render on this many processes instead")
+    parser.add_argument("--force", action="store_true",
+                        help="re-render tweets that are fresh")
+    parser.add_argument("--urgent", action="store_true",
+                        help="call Twitter with user priority, taking from "
+                             "the reserve of live requests")
+    parser.add_argument("-v", action="store_true", help="debug logging")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.v else logging.WARNING)
+
+    ids = parse_ids(fileinput.input(args.files))
+    configure(args.server)
+    import ratelimit
+    summary = run(ids, args.processes or args.threads, bool(args.processes),
+                  args.force,
+                  ratelimit.USER if args.urgent else ratelimit.BACKGROUND,
+                  args.server)
+
+    print "%d tweets: %s" % (summary['tweets'], ", ".join(
+        "%d %s" % (count, outcome)
+        for outcome, count in sorted(summary['outcomes'].items())))
+    print "Lookups %.1fs, renders %.1fs, %.2f renders/s" % (
+        summary['lookup_s'], summary['render_s'], summary['renders_per_s'])
+    if summary['render_ms']['count']:
+        print "Render time p50 %(p50).0fms, p90 %(p90).0fms, max %(max).0fms" \
+            % summary['render_ms']
+    print "Remote calls: %s" % ", ".join(
+        "%d %s" % (value, name)
+        for name, value in sorted(summary['totals'].items())
+        if name.endswith("_calls") or name == "asset_fetches")
@@ -0,0 +1,167 @@
+"""A reservoir of existing tweets for /random/.
+
+Nearly all random ids are of no tweet, so finding one takes many probes.
+They're made ahead of time, in the background: a refill looks up
+`twitter.LOOKUP_MAX` random ids per statuses/lookup call and keeps the
+tweets found, newest first, in a pool of `settings.RANDOM_POOL_SIZE` in
+memcache. Serving a random tweet is then a memcache get; an empty pool
+serves nothing until refilled. Every quarter of the pool served, a refill
+replaces the oldest ones, at most one per `PENDING_TIME`, on the task queue
+("random" in queue.yaml) or the instance. Until the pool is full, each
+refill lets the next request queue another. Refills call the API with
+background priority, see `ratelimit`, and log their hit ratio.
+
+Ids are sampled as Twitter makes them ("Snowflakes"): milliseconds since
+`EPOCH`, within the last `settings.RANDOM_WINDOW` seconds, then a random
+worker and a sequence number of 0, the most common.
+"""
+
+import logging
+from random import choice, randint
+from threading import Lock
+import time
+
+from google.appengine.api import memcache
+
+import ratelimit
+from ratelimit import RateLimited
+from refresh import LocalQueue
+import settings
+import tweets
+import twitter
+
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    taskqueue = None
+
+
+KEY = "random-pool"
+SERVED_KEY = "random-pool:served"
+REFILLING_KEY = "random-pool:refilling"
+
+URL = "/tasks/random-refill"
+QUEUE = "random"
+
+# How long a queued refill keeps others from queuing
+PENDING_TIME = 5 * 60
+
+# Twitter's Snowflake epoch, in milliseconds
+EPOCH = 1288834974657
+
+
+def random_ids(n, window):
+    """`n` random Snowflake ids from the last `window` seconds."""
+    now = int(time.time() * 1000) - EPOCH
+    return [((now - randint(0, window * 1000)) << 22) | (randint(0, 1023) << 12)
+            for _i in range(n)]
+
+
+class Pool(object):
+    """Tweets for the taking, refilled by `refill_calls` lookups at most at
+    a time."""
+
+    def __init__(self, size=None, refill_calls=None, backend=None):
+        self.size = size or settings.RANDOM_POOL_SIZE
+        self.refill_calls = refill_calls or settings.RANDOM_REFILL_CALLS
+        backend = backend or settings.REFRESH_QUEUE
+        if backend == "taskqueue" and taskqueue is None:
+            backend = "local"
+        self.backend = backend
+        self.local = LocalQueue(lambda _task: self.refill(), 1)
+        self._lock = Lock()
+        self.served = self.empty = self.refills = 0
+        self.probed = self.found = 0
+
+    def get(self):
+        """A random tweet of the pool, or None if it's empty. Probing on
+        the spot would seldom find one, with user priority."""
+        pool = memcache.get(KEY)
+        if not pool:
+            with self._lock:
+                self.empty += 1
+            self.queue()
+            return None
+        if memcache.incr(SERVED_KEY, initial_value=0) >= self.size / 4 \
+                or len(pool) < self.size:
+            self.queue()
+        with self._lock:
+            self.served += 1
+        tweet = choice(pool)
+        # It's likely to be rendered next
+        memcache.add(tweets.KEY % tweet['id'], tweet, time=settings.TWEET_TTL)
+        return tweet
+
+    def probe(self):
+        """Tweets found by one lookup of random ids, as compact records."""
+        ids = random_ids(twitter.LOOKUP_MAX, settings.RANDOM_WINDOW)
+        found = [tweets.compact(tweet) for tweet in twitter.lookup(ids).values()
+                 if tweet and tweet.get('text')]
+        with self._lock:
+            self.probed += len(ids)
+            self.found += len(found)
+        return found
+
+    def _add(self, found):
+        pool = (found + (memcache.get(KEY) or []))[:self.size]
+        if found:
+            memcache.set(KEY, pool)
+        return pool
+
+    def queue(self):
+        """Queues a refill, unless there was one in the last
+        `PENDING_TIME`."""
+        if not memcache.add(REFILLING_KEY, 1, time=PENDING_TIME):
+            return False
+        if self.backend == "taskqueue":
+            try:
+                taskqueue.add(url=URL, queue_name=QUEUE)
+            except (taskqueue.Error, ValueError), e:
+                logging.warning("Queuing random pool refill failed: %r" % e)
+                memcache.delete(REFILLING_KEY)
+                return False
+        else:
+            self.local.add(None)
+        return True
+
+    def refill(self):
+        """Probes until a quarter of the pool is replaced, or for
+        `refill_calls` lookups, with background priority. Unless rate
+        limited, a pool that's still short may be refilled again right
+        away."""
+        found, calls, limited = [], 0, False
+        with ratelimit.priority(ratelimit.BACKGROUND):
+            for calls in range(1, self.refill_calls + 1):
+                try:
+                    found += self.probe()
+                except RateLimited, e:
+                    logging.info("Random pool refill stopped: %s" % e)
+                    calls, limited = calls - 1, True
+                    break
+                if len(found) >= self.size / 4:
+                    break
+        pool = self._add(found)
+        memcache.set(SERVED_KEY, 0)
+        probed = calls * twitter.LOOKUP_MAX
+        logging.info("Random pool refill found %d tweets in %d ids (%.2f%%), "
+                     "pool has %d" % (len(found), probed,
+                                      100.0 * len(found) / (probed or 1),
+                                      len(pool)))
+        if not limited and len(pool) < self.size:
+            memcache.delete(REFILLING_KEY)
+        with self._lock:
+            self.refills += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.backend,
+                'served': self.served,
+                'served_empty': self.empty,
+                'refills': self.refills,
+                'ids_probed': self.probed,
+                'tweets_found': self.found,
+                'hit_ratio': self.found / float(self.probed or 1),
+            }
+
+POOL = Pool()
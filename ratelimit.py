@@ -0,0 +1,151 @@
+"""Twitter API rate limits, shared by the instances through memcache.
+
+Every response tells how many calls are left in the endpoint's 15 minute
+window (x-rate-limit-remaining) and when it resets (x-rate-limit-reset).
+Those are kept in memcache, and counted down as calls are made, so that
+the instances stop calling once the budget is spent instead of collecting
+429s. Background work (refreshing stale shots) stops earlier, leaving the
+last `settings.TWITTER_BACKGROUND_RESERVE` calls of a window to user-facing
+misses. After a 429 all calls to the endpoint back off until the reset, or
+for a doubling delay if the response doesn't say.
+"""
+
+from contextlib import contextmanager
+import logging
+from threading import local, Lock
+import time
+import urlparse
+
+from google.appengine.api import memcache
+
+import settings
+
+
+# Priorities, most urgent first
+USER, BACKGROUND = 0, 1
+
+# Backoff after a 429 without a reset time, in seconds
+BACKOFF_MIN = 60
+BACKOFF_MAX = 15 * 60
+
+
+class RateLimited(Exception):
+    def __init__(self, endpoint, reset):
+        self.endpoint, self.reset = endpoint, reset
+        super(RateLimited, self).__init__(
+            "Twitter API rate limit of %s reached, resets in %ds"
+            % (endpoint, self.retry_after()))
+
+    def retry_after(self):
+        """Seconds until the limit resets."""
+        return max(int(self.reset - time.time()), 1)
+
+
+_local = local()
+
+def current():
+    """Priority of the calls of this thread."""
+    return getattr(_local, 'priority', USER)
+
+@contextmanager
+def priority(value):
+    """Makes the calls of the enclosed block with priority `value`."""
+    previous, _local.priority = current(), value
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def endpoint(url):
+    """The rate limited resource of an API URL, like "statuses/show"."""
+    path = urlparse.urlsplit(url).path.split("/")[2:]
+    if path:
+        path[-1] = path[-1].rsplit(".", 1)[0]
+    return "/".join(part for part in path if not part.isdigit())
+
+
+class Limits(object):
+    """Rate limit state of the endpoints, in memcache under `prefix`."""
+
+    def __init__(self, prefix="ratelimit:", reserve=None):
+        self.prefix = prefix
+        self.reserve = (settings.TWITTER_BACKGROUND_RESERVE if reserve is None
+                        else reserve)
+        self._lock = Lock()
+        self.allowed, self.limited, self.too_many = 0, [0, 0], 0
+        self.known = {}
+
+    def _keys(self, endpoint):
+        return ["%s%s:%s" % (self.prefix, what, endpoint)
+                for what in ("remaining", "reset", "backoff")]
+
+    def acquire(self, endpoint, priority=None):
+        """Takes a call to `endpoint` from the budget. Raises `RateLimited`
+        if there's none left for calls of `priority` (default the thread's
+        `current`)."""
+        priority = current() if priority is None else priority
+        remaining_key, reset_key, backoff_key = self._keys(endpoint)
+        state = memcache.get_multi([remaining_key, reset_key, backoff_key])
+        now = time.time()
+        backoff = state.get(backoff_key)
+        if backoff and backoff[0] > now:
+            self._limited(priority)
+            raise RateLimited(endpoint, backoff[0])
+        remaining, reset = state.get(remaining_key), state.get(reset_key)
+        if remaining is not None and reset is not None and reset > now:
+            if remaining <= (self.reserve if priority == BACKGROUND else 0):
+                self._limited(priority)
+                raise RateLimited(endpoint, reset)
+            # Others see this call before its response updates the count
+            memcache.decr(remaining_key)
+        with self._lock:
+            self.allowed += 1
+
+    def _limited(self, priority):
+        with self._lock:
+            self.limited[priority] += 1
+
+    def update(self, endpoint, rs):
+        """Records the limits in response `rs`. Raises `RateLimited` if it
+        is a 429."""
+        remaining_key, reset_key, backoff_key = self._keys(endpoint)
+        now = time.time()
+        try:
+            remaining = int(rs.headers['x-rate-limit-remaining'])
+            reset = int(rs.headers['x-rate-limit-reset'])
+        except (KeyError, TypeError, ValueError):
+            remaining = reset = None
+        if reset is not None and reset > now:
+            memcache.set_multi({remaining_key: remaining, reset_key: reset},
+                               time=int(reset - now) + 1)
+            with self._lock:
+                self.known[endpoint] = {'remaining': remaining, 'reset': reset}
+
+        if rs.status_code == 429:
+            with self._lock:
+                self.too_many += 1
+            if reset is not None and reset > now:
+                until, delay = reset, reset - now
+            else:
+                backoff = memcache.get(backoff_key)
+                delay = min(backoff[1] * 2 if backoff else BACKOFF_MIN,
+                            BACKOFF_MAX)
+                until = now + delay
+            # Kept for another delay, so that a 429 right after doubles it
+            memcache.set(backoff_key, (until, delay), time=int(2 * delay) + 1)
+            logging.warning("Twitter API rate limit of %s hit, backing off "
+                            "for %ds" % (endpoint, until - now))
+            raise RateLimited(endpoint, until)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'allowed': self.allowed,
+                'limited_user': self.limited[USER],
+                'limited_background': self.limited[BACKGROUND],
+                'too_many_requests': self.too_many,
+                'last_seen': dict(self.known),
+            }
+
+LIMITS = Limits()
@@ -0,0 +1,124 @@
+"""Background re-rendering of stale shots.
+
+A stale shot is served right away and a refresh is queued: on the task
+queue ("refresh" in queue.yaml, which caps how many run at once), or with
+the local stand-in, a few worker threads on the instance. Either way a
+tweet is queued once per `PENDING_TIME`, however many requests see it
+stale. Refreshes call the Twitter API with background priority, and are
+dropped when it's out of calls for them: the stale shot stays served.
+"""
+
+import logging
+import Queue
+from threading import Lock, Thread
+
+from google.appengine.api import memcache
+
+import ratelimit
+import settings
+
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    taskqueue = None
+
+
+URL = "/tasks/refresh"
+QUEUE = "refresh"
+
+# How long a queued refresh keeps others from queuing the same tweet
+PENDING_TIME = 5 * 60
+
+
+class LocalQueue(object):
+    """Runs tasks on at most `concurrency` threads of the instance."""
+
+    def __init__(self, run, concurrency):
+        self.run, self.concurrency = run, concurrency
+        self._tasks = Queue.Queue()
+        self._workers, self._lock = [], Lock()
+
+    def add(self, task):
+        self._tasks.put(task)
+        with self._lock:
+            if len(self._workers) < self.concurrency:
+                worker = Thread(target=self._work, name="refresh")
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                self.run(task)
+            except Exception, e:
+                logging.exception("Background task %r failed: %s" % (task, e))
+            finally:
+                self._tasks.task_done()
+
+
+class Refresher(object):
+    """Queues `render(tweet_id)` of stale tweets."""
+
+    def __init__(self, render, backend=None, concurrency=None):
+        self.render = render
+        backend = backend or settings.REFRESH_QUEUE
+        if backend == "taskqueue" and taskqueue is None:
+            logging.warning("Task queue not available, refreshing locally")
+            backend = "local"
+        self.backend = backend
+        self.local = LocalQueue(self.run,
+                                concurrency or settings.REFRESH_CONCURRENCY)
+        self.queued = self.pending = self.refreshed = self.failed = 0
+        self.limited = 0
+
+    @staticmethod
+    def _key(tweet_id):
+        return "refresh:%s" % tweet_id
+
+    def queue(self, tweet_id):
+        """Queues a refresh of `tweet_id` unless one is pending already.
+        Returns whether it was queued."""
+        if not memcache.add(self._key(tweet_id), 1, time=PENDING_TIME):
+            self.pending += 1
+            return False
+        if self.backend == "taskqueue":
+            try:
+                taskqueue.add(url=URL, params={'id': tweet_id},
+                              queue_name=QUEUE)
+            except (taskqueue.Error, ValueError), e:
+                logging.warning("Queuing refresh of %s failed: %r"
+                                % (tweet_id, e))
+                memcache.delete(self._key(tweet_id))
+                return False
+        else:
+            self.local.add(tweet_id)
+        self.queued += 1
+        return True
+
+    def run(self, tweet_id):
+        """Re-renders `tweet_id`, as queued."""
+        try:
+            with ratelimit.priority(ratelimit.BACKGROUND):
+                self.render(tweet_id)
+            self.refreshed += 1
+        except ratelimit.RateLimited, e:
+            # Not retried, the next request seeing it stale queues it again
+            logging.info("Refresh of %s dropped: %s" % (tweet_id, e))
+            self.limited += 1
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            memcache.delete(self._key(tweet_id))
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'queued': self.queued,
+            'already_pending': self.pending,
+            'refreshed': self.refreshed,
+            'failed': self.failed,
+            'rate_limited': self.limited,
+        }
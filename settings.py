@@ -0,0 +1,79 @@
+"""Tunables. Override by editing, like `secrets.py`."""
+
+# How many line prefixes to probe in parallel per Chart API round trip
+# when fitting text to lines. 1 does a sequential (binary) search.
+LINE_SEARCH_FANOUT = 4
+
+# Compositing backend: "raster" blends in memory with PIL, "images" uses
+# the App Engine images API (also the fallback if PIL is unavailable).
+COMPOSITOR = "raster"
+
+# How long parsed tweets are cached, in seconds
+TWEET_TTL = 6 * 60 * 60
+
+# How long the first tweet lookup on an instance waits for concurrent ones
+# to batch with, in seconds
+TWEET_LOOKUP_WINDOW = .05
+
+# Rendered images are served as they are for SHOT_TTL seconds. After that
+# they're still served, but re-rendered in the background, until they
+# expire for good after SHOT_HARD_TTL.
+SHOT_TTL = 24 * 60 * 60
+SHOT_HARD_TTL = 7 * 24 * 60 * 60
+
+# Where background re-renders run: "taskqueue" (the refresh queue in
+# queue.yaml) or "local" (threads on the instance, also the fallback
+# without the task queue API), and how many at once
+REFRESH_QUEUE = "taskqueue"
+REFRESH_CONCURRENCY = 2
+
+# Where rendered images memcache can't hold, and line layouts, are kept:
+# "datastore", "disk" (a temporary directory, for the development server)
+# or None
+SHOT_FALLBACK = "datastore"
+
+# Whether PNGs with more than 256 colours (photo backgrounds) are quantized
+# to a palette too, and the quality of WebP and JPEG images, 1-100
+PNG_QUANTIZE = True
+LOSSY_QUALITY = 85
+
+# Text rendering: "local" draws with PIL and the TrueType font TEXT_FONT,
+# which has glyphs for the TEXT_FONT_SCRIPTS buckets of glyphs.py. Other
+# texts, or all of them if the font or PIL is missing, are rendered by the
+# TEXT_FALLBACK backend: "chart" (the Chart API) or None.
+TEXT_BACKEND = "local"
+TEXT_FALLBACK = "chart"
+TEXT_FONT = "fonts/DejaVuSans.ttf"
+TEXT_FONT_SCRIPTS = ("latin",)
+
+# How Twitter API requests are sent: "urlfetch", or "pooled" over up to
+# TWITTER_POOL_SIZE kept-alive connections per host, which needs outbound
+# sockets (on App Engine, GAE_USE_SOCKETS_HTTPLIB in app.yaml's
+# env_variables)
+TWITTER_TRANSPORT = "urlfetch"
+TWITTER_POOL_SIZE = 4
+
+# Twitter API calls of each rate limit window left to user-facing misses:
+# background refreshes stop when there are this few
+TWITTER_BACKGROUND_RESERVE = 30
+
+# /random/ serves tweets from a pool of RANDOM_POOL_SIZE, refilled with at
+# most RANDOM_REFILL_CALLS lookups of random ids from the last
+# RANDOM_WINDOW seconds at a time. At some 6 tweets per millisecond over
+# 1024 workers, at most ~0.5% of the ids sampled are tweets, about one per
+# two lookups: a refill finds ~10. Refills log the ratio they get, and
+# /stats/ has it as random_pool.hit_ratio; tune the calls by that.
+RANDOM_POOL_SIZE = 200
+RANDOM_REFILL_CALLS = 20
+RANDOM_WINDOW = 7 * 24 * 60 * 60
+
+# How long a tweet that failed to render keeps failing without another
+# try, by the status of the error: 404 no such (visible) tweet, 502 Twitter
+# API error, 500 anything else. Clients may cache the error image as long.
+FAILURE_TTLS = {404: 10 * 60, 502: 60, 500: 5 * 60}
+
+# Rendered images are kept on the instance too, up to SHOT_CACHE_BYTES,
+# once they've been asked for SHOT_CACHE_ADMIT times (missed on the
+# instance that many times, so one-off requests don't push out hot ones)
+SHOT_CACHE_BYTES = 24 * 2**20
+SHOT_CACHE_ADMIT = 2
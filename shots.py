@@ -0,0 +1,181 @@
+"""Storage of rendered tweet images ("shots") and their width variants.
+
+The standard widths offered on the index page are resized right after
+rendering and stored along with the full image. Other widths are resized
+on demand and stored the same. Shots asked for repeatedly are kept on the
+instance too, in a byte-budgeted LRU, until they go stale. Every image is stored
+with its ETag, so conditional requests can be answered without touching
+the images API, and the time it was rendered: past `TTL` a shot is stale,
+still served but due for re-rendering, until it expires after `HARD_TTL`.
+Large images are split over several memcache entries, see `store`.
+
+Stored PNGs are palette-optimized. Other formats (see `formats`) are
+encoded from the full size PNG on demand and cached like other widths.
+"""
+
+from collections import namedtuple
+from hashlib import sha1
+import logging
+from threading import Lock
+import time
+
+from google.appengine.api import images
+
+from cache import AdmittingCache, LRUCache
+import formats
+import settings
+import store
+
+
+TTL, HARD_TTL = settings.SHOT_TTL, settings.SHOT_HARD_TTL
+
+# Widths rendered up front, as offered on the index page
+WIDTHS = (600, 500, 400, 300)
+
+MIN_WIDTH = 300
+
+Shot = namedtuple('Shot', 'img etag rendered')
+
+# Hot shots of any width and format
+LOCAL = AdmittingCache(LRUCache(max_items=1000,
+                                max_bytes=settings.SHOT_CACHE_BYTES,
+                                sizeof=lambda shot: len(shot.img)),
+                       settings.SHOT_CACHE_ADMIT)
+
+STORE = store.ChunkedStore(store.fallback())
+
+
+def key(tweet_id, width=None, fmt=formats.DEFAULT):
+    k = "%s-%d" % (tweet_id, width) if width else str(tweet_id)
+    return k if fmt == formats.DEFAULT else "%s.%s" % (k, fmt)
+
+def etag(img):
+    """Strong ETag of image bytes."""
+    return '"%s"' % sha1(img).hexdigest()
+
+def _shot(value):
+    # Entries from before ETags were stored are bare image data, and before
+    # render times `(img, etag)`; both count as stale
+    if isinstance(value, str):
+        return Shot(value, etag(value), 0)
+    if value and len(value) == 2:
+        return Shot(*value + (0,))
+    return value and Shot(*value)
+
+def stale(shot):
+    """Whether `shot` is past its `TTL` and should be re-rendered."""
+    return time.time() - shot.rendered > TTL
+
+def max_age(shot):
+    """Seconds `shot` may be cached by clients: until it goes stale, and
+    then only briefly, as a fresh one is on its way."""
+    return max(int(shot.rendered + TTL - time.time()), 60)
+
+_lock = Lock()
+_stored = [0, 0]
+
+def _keep(k, shot):
+    """Keeps `shot` on the instance, if it's hot, until it goes stale."""
+    if not stale(shot):
+        LOCAL.set(k, shot, shot.rendered + TTL)
+
+def get(tweet_id, width=None, fmt=formats.DEFAULT, count=True):
+    """The stored `Shot` of `tweet_id` at `width` in `fmt`, or None. Only
+    lookups with `count` make it hot enough to keep on the instance, and
+    count in the stats: pass False when polling or searching for one."""
+    k = key(tweet_id, width, fmt)
+    shot = LOCAL.get(k, count)
+    if shot is None:
+        shot = _shot(STORE.get(k))
+        if count:
+            with _lock:
+                _stored[shot is None] += 1
+        if shot:
+            _keep(k, shot)
+    return shot
+
+def put(tweet_id, img):
+    """Stores a freshly rendered image along with its standard width
+    variants. Returns a dict of the `Shot`s by width, None for the full
+    size."""
+    img = formats.encode(img)
+    full_width = images.Image(img).width
+    rendered = int(time.time())
+    shots = {None: Shot(img, etag(img), rendered)}
+    for width in WIDTHS:
+        if width < full_width:
+            resized = formats.encode(images.resize(img, width))
+            shots[width] = Shot(resized, etag(resized), rendered)
+    failed = STORE.set_multi(dict((key(tweet_id, width), tuple(shot))
+                                  for width, shot in shots.items()),
+                             time=HARD_TTL)
+    if failed:
+        logging.warning("Failed to store %r" % (failed,))
+    for width, shot in shots.items():
+        _keep(key(tweet_id, width), shot)
+    return shots
+
+def clamp(width):
+    """Requested `width` raised to MIN_WIDTH, as it's served and stored;
+    None for the full size. A width of 0 is MIN_WIDTH too."""
+    return None if width is None else max(width, MIN_WIDTH)
+
+def variant(tweet_id, full, width=None, fmt=formats.DEFAULT):
+    """`Shot` of `width` in `fmt` made from the `full` size shot, cached on
+    demand. The width is clamped between MIN_WIDTH and the full width, and
+    the variant stored under the clamped width, so it's stored once however
+    it's asked for; at the full width it's `full` itself. The variant is as
+    old as `full`."""
+    full_width = images.Image(full.img).width
+    width = min(clamp(width) or full_width, full_width)
+    if width == full_width:
+        if fmt == formats.DEFAULT:
+            return full
+        width = None
+    img = full.img
+    if width:
+        img = images.resize(img, width)
+    img = formats.encode(img, fmt)
+    shot = Shot(img, etag(img), full.rendered)
+    k = key(tweet_id, width, fmt)
+    _keep(k, shot)
+    STORE.set_multi({k: tuple(shot)},
+                    time=max(int(full.rendered + HARD_TTL - time.time()), 1))
+    return shot
+
+def last_good(tweet_id, width=None, fmt=formats.DEFAULT):
+    """Any stored `Shot` of `tweet_id`, for when it can't be rendered: at
+    `width` or the closest width stored, in `fmt` or else PNG. Returns it
+    and its format, or `(None, None)`."""
+    # The full size is wider than any standard width
+    widths = [None] + sorted(WIDTHS, reverse=True)
+    if width:
+        widths = [width] + sorted([w for w in widths if w != width],
+                                  key=lambda w: abs((w or 10000) - width))
+    for f in [fmt] + [formats.DEFAULT] * (fmt != formats.DEFAULT):
+        for w in widths:
+            shot = get(tweet_id, w, f, count=False)
+            if shot:
+                return shot, f
+    return None, None
+
+def matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches `etag`."""
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    # Weak comparison, as specified for If-None-Match
+    return "*" in tags or etag in [t[2:] if t.startswith("W/") else t
+                                   for t in tags]
+
+
+def stats():
+    """Hits of each tier: the instance, then memcache and the fallback
+    store."""
+    with _lock:
+        hits, misses = _stored
+    return {
+        'local': LOCAL.stats(),
+        'store': {'hits': hits, 'misses': misses,
+                  'hit_ratio': hits / float(hits + misses or 1)},
+    }
@@ -0,0 +1,99 @@
+"""Coalescing of concurrent renders of the same tweet.
+
+When a tweet goes viral, lots of requests miss the cache at once. Only one
+of them should render: on an instance the others wait for it in-process,
+across instances a lease in memcache tells the others to poll for the
+result instead.
+"""
+
+import logging
+import os
+from threading import Event, Lock
+import time
+
+from google.appengine.api import memcache
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = self.error = None
+
+
+class SingleFlight(object):
+    """Runs one render per key at a time, across instances.
+
+    `lease_time` bounds how long a lease holder is trusted to finish, `wait`
+    how long others wait for its result before rendering themselves."""
+
+    def __init__(self, prefix="lease:", lease_time=30, wait=10, poll=.25):
+        self.prefix, self.lease_time = prefix, lease_time
+        self.wait, self.poll = wait, poll
+        self._flights, self._lock = {}, Lock()
+        self.renders = self.joined = self.polled = self.timeouts = 0
+
+    def do(self, key, render, lookup):
+        """Returns `render()`, unless a render of `key` is already going on;
+        then waits for it and returns its result, or `lookup()` if it
+        happened on another instance."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            if flight.done.wait(self.wait):
+                self.joined += 1
+                if flight.error:
+                    raise flight.error
+                return flight.result
+            # Taking too long, go ahead on our own
+            self.timeouts += 1
+            return render()
+
+        try:
+            flight.result = self._leased(key, render, lookup)
+            return flight.result
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _leased(self, key, render, lookup):
+        lease = self.prefix + str(key)
+        holder = os.environ.get('INSTANCE_ID', "local")
+        if not memcache.add(lease, holder, time=self.lease_time):
+            logging.debug("Render of %s leased by %s, waiting"
+                          % (key, memcache.get(lease)))
+            deadline = time.time() + self.wait
+            while time.time() < deadline:
+                time.sleep(self.poll)
+                result = lookup()
+                if result:
+                    self.polled += 1
+                    return result
+                if memcache.get(lease) is None:
+                    # Holder gave up (or failed); our turn
+                    break
+            else:
+                self.timeouts += 1
+            memcache.set(lease, holder, time=self.lease_time)
+
+        self.renders += 1
+        try:
+            return render()
+        finally:
+            memcache.delete(lease)
+
+    def stats(self):
+        return {
+            'renders': self.renders,
+            'joined': self.joined,
+            'polled': self.polled,
+            'timeouts': self.timeouts,
+            'duplicates_prevented': self.joined + self.polled,
+        }
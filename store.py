@@ -0,0 +1,279 @@
+"""Storage of values too large for a single memcache entry.
+
+Values are tuples whose first item is the (large) data. Up to `CHUNK_SIZE`
+they're stored as they are. Larger data is split over several entries, with
+a `Manifest` under the key itself; reading it back takes one `get_multi`
+for all the chunks. Whatever memcache won't take, or loses, can be kept in
+a persistent fallback: the datastore, or a directory on local disk.
+Expired values are only ignored when read; `purge`, run by cron
+(cron.yaml), deletes them.
+
+The data isn't compressed further: it's PNG, deflated already.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from hashlib import sha1
+import logging
+import os
+import cPickle as pickle
+import tempfile
+from threading import Lock
+import time as _time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import settings
+
+
+# memcache values are limited to 10**6 bytes once pickled; values of up to
+# a chunk are stored in a tuple, with room for the rest of it
+CHUNK_SIZE = 1000 * 1000 - 1024
+
+# Upper bounds of the object size histogram
+SIZE_BUCKETS = (100 * 1000, 500 * 1000, CHUNK_SIZE, 2 * CHUNK_SIZE)
+
+# Expired entities deleted per datastore call when purging
+PURGE_BATCH = 500
+
+Manifest = namedtuple('Manifest', 'chunks size digest rest')
+
+
+def _chunk_keys(key, chunks):
+    return ["%s#%d" % (key, n) for n in range(chunks)]
+
+def _set_multi(mapping, time):
+    """`memcache.set_multi`, also returning the keys of values memcache
+    refuses as too large: it raises `ValueError` for those, failing the
+    whole call."""
+    try:
+        return memcache.set_multi(mapping, time=time) or []
+    except ValueError:
+        failed = []
+        for key, value in mapping.items():
+            try:
+                stored = memcache.set(key, value, time=time)
+            except ValueError, e:
+                logging.warning("memcache refused %s: %s" % (key, e))
+                stored = False
+            if not stored:
+                failed.append(key)
+        return failed
+
+
+class StoredChunk(db.Model):
+    """Chunk of a value in the datastore fallback, keyed by its memcache
+    key. The first chunk holds the rest of the value. Every chunk has the
+    expiry time, to be found by `purge`."""
+    data = db.BlobProperty()
+    chunks = db.IntegerProperty()
+    rest = db.BlobProperty()
+    expires = db.DateTimeProperty()
+
+
+class DatastoreFallback(object):
+    name = "datastore"
+
+    def _entities(self, key, value, time):
+        data = value[0]
+        chunks = [data[i:i + CHUNK_SIZE]
+                  for i in range(0, len(data), CHUNK_SIZE)] or [""]
+        expires = datetime.utcnow() + timedelta(seconds=time)
+        keys = [key] + _chunk_keys(key, len(chunks))[1:]
+        entities = [StoredChunk(key_name=k, data=db.Blob(chunk), expires=expires)
+                    for k, chunk in zip(keys, chunks)]
+        head = entities[0]
+        head.chunks = len(chunks)
+        head.rest = db.Blob(pickle.dumps(tuple(value[1:]), -1))
+        return entities
+
+    def set(self, key, value, time):
+        db.put(self._entities(key, value, time))
+
+    def set_async(self, key, value, time):
+        """Starts storing `value`; returns the RPC."""
+        return db.put_async(self._entities(key, value, time))
+
+    def get(self, key):
+        head = StoredChunk.get_by_key_name(key)
+        if head is None or head.expires < datetime.utcnow():
+            return None
+        rest = StoredChunk.get_by_key_name(_chunk_keys(key, head.chunks)[1:])
+        if None in rest:
+            return None
+        data = "".join([head.data] + [chunk.data for chunk in rest])
+        return (data,) + pickle.loads(head.rest)
+
+    def purge(self, batches=20):
+        """Deletes expired chunks, up to `batches` of `PURGE_BATCH`.
+        Returns how many."""
+        deleted = 0
+        for _i in range(batches):
+            keys = StoredChunk.all(keys_only=True) \
+                .filter("expires <", datetime.utcnow()).fetch(PURGE_BATCH)
+            db.delete(keys)
+            deleted += len(keys)
+            if len(keys) < PURGE_BATCH:
+                break
+        return deleted
+
+
+class DiskFallback(object):
+    """Pickled values in files under `path`, for the development server."""
+    name = "disk"
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(tempfile.gettempdir(), "tweetpong")
+
+    def _file(self, key):
+        return os.path.join(self.path, sha1(key).hexdigest())
+
+    def set(self, key, value, time):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        tmp = self._file(key) + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((_time.time() + time, value), f, -1)
+        os.rename(tmp, self._file(key))
+
+    def set_async(self, key, value, time):
+        """Stores `value` right away, there's no RPC to return."""
+        self.set(key, value, time)
+
+    def get(self, key):
+        try:
+            with open(self._file(key), "rb") as f:
+                expires, value = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        return value if expires > _time.time() else None
+
+    def purge(self):
+        """Deletes the files of expired values. Returns how many."""
+        deleted = 0
+        if not os.path.isdir(self.path):
+            return deleted
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                with open(path, "rb") as f:
+                    expires, _value = pickle.load(f)
+                if expires <= _time.time():
+                    os.remove(path)
+                    deleted += 1
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                pass
+        return deleted
+
+
+def fallback(name=None):
+    """The fallback store named `name` (default `settings.SHOT_FALLBACK`),
+    or None."""
+    name = name if name is not None else settings.SHOT_FALLBACK
+    return {"datastore": DatastoreFallback,
+            "disk": DiskFallback}.get(name, lambda: None)()
+
+
+class ChunkedStore(object):
+    """memcache for large values, backed by `fallback`. Keeps counts of the
+    sizes stored and of how often the fallback is needed."""
+
+    def __init__(self, fallback=None, chunk_size=CHUNK_SIZE):
+        self.fallback, self.chunk_size = fallback, chunk_size
+        self._lock = Lock()
+        self.objects = self.bytes = self.max_bytes = self.chunked = 0
+        self.sizes = [0] * (len(SIZE_BUCKETS) + 1)
+        self.fallback_writes = self.fallback_hits = self.fallback_misses = 0
+        self.broken = 0
+
+    def _count(self, size):
+        with self._lock:
+            self.objects += 1
+            self.bytes += size
+            self.max_bytes = max(self.max_bytes, size)
+            self.sizes[len([b for b in SIZE_BUCKETS if b < size])] += 1
+
+    def set_multi(self, mapping, time=0):
+        """Stores the values of `mapping` by key. Returns the keys neither
+        memcache nor the fallback took."""
+        entries, parts = {}, {}
+        for key, value in mapping.items():
+            data = value[0]
+            self._count(len(data))
+            if len(data) <= self.chunk_size:
+                entries[key] = value
+                continue
+            self.chunked += 1
+            chunks = [data[i:i + self.chunk_size]
+                      for i in range(0, len(data), self.chunk_size)]
+            keys = _chunk_keys(key, len(chunks))
+            entries.update(zip(keys, chunks))
+            # The manifest goes last, once the chunks are in
+            parts[key] = keys
+            entries[key] = Manifest(len(chunks), len(data),
+                                    sha1(data).hexdigest(), tuple(value[1:]))
+        manifests = dict((key, entries.pop(key)) for key in parts)
+        failed = set(_set_multi(entries, time))
+        complete = dict((key, manifest) for key, manifest in manifests.items()
+                        if not failed.intersection(parts[key]))
+        failed.update(set(manifests) - set(complete))
+        failed.update(_set_multi(complete, time))
+
+        failed = [key for key in mapping if key in failed]
+        if self.fallback:
+            # Chunked values are lost with any of their chunks, so they're
+            # kept in the fallback too
+            for key in set(failed) | set(parts):
+                try:
+                    self.fallback.set(key, mapping[key], time)
+                except Exception, e:
+                    logging.warning("Storing %s in %s failed: %s"
+                                    % (key, self.fallback.name, e))
+                else:
+                    self.fallback_writes += 1
+                    if key in failed:
+                        failed.remove(key)
+        return failed
+
+    def get(self, key):
+        """The value stored under `key`, or None."""
+        value = memcache.get(key)
+        if isinstance(value, Manifest):
+            chunks = memcache.get_multi(_chunk_keys(key, value.chunks))
+            if len(chunks) == value.chunks:
+                data = "".join(chunks[k] for k in _chunk_keys(key, value.chunks))
+                if sha1(data).hexdigest() == value.digest:
+                    return (data,) + value.rest
+            logging.warning("Chunks of %s missing or corrupt" % key)
+            self.broken += 1
+            value = None
+        if value is None and self.fallback:
+            try:
+                value = self.fallback.get(key)
+            except Exception, e:
+                logging.warning("Reading %s from %s failed: %s"
+                                % (key, self.fallback.name, e))
+            if value is None:
+                self.fallback_misses += 1
+            else:
+                self.fallback_hits += 1
+        return value
+
+    def stats(self):
+        stored = self.objects or 1
+        return {
+            'objects': self.objects,
+            'mean_bytes': self.bytes / stored,
+            'max_bytes': self.max_bytes,
+            'sizes': dict(("<=%dk" % (b / 1000), n)
+                          for b, n in zip(SIZE_BUCKETS, self.sizes)),
+            'larger': self.sizes[-1],
+            'chunked': self.chunked,
+            'broken': self.broken,
+            'fallback': self.fallback and self.fallback.name,
+            'fallback_writes': self.fallback_writes,
+            'fallback_hits': self.fallback_hits,
+            'fallback_misses': self.fallback_misses,
+            'fallback_write_ratio': self.fallback_writes / float(stored),
+        }
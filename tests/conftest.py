@@ -0,0 +1,16 @@
+"""Tests run offline: unless the App Engine SDK is importable, against the
+stand-ins of the benchmark (see bench/standins).
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import google.appengine.api
+except ImportError:
+    sys.path.insert(0, os.path.join(ROOT, "bench", "standins"))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,21 @@
+import time
+
+from cache import AdmittingCache, LRUCache
+
+
+def test_admitted_after_repeated_misses():
+    cache = AdmittingCache(LRUCache(), admit_after=2)
+    expires = time.time() + 60
+    assert cache.get("k") is None
+    assert not cache.set("k", "v", expires)
+    assert cache.get("k") is None
+    assert cache.set("k", "v", expires)
+    assert cache.get("k") == "v"
+
+def test_uncounted_lookups_neither_admit_nor_count():
+    cache = AdmittingCache(LRUCache(), admit_after=2)
+    expires = time.time() + 60
+    for _i in range(5):
+        assert cache.get("k", count=False) is None
+    assert not cache.set("k", "v", expires)
+    assert cache.stats()['misses'] == 0
@@ -0,0 +1,27 @@
+from formats import negotiate
+
+
+def test_negotiate_defaults_to_png():
+    assert negotiate(None) == "png"
+    assert negotiate("") == "png"
+    assert negotiate("text/html") == "png"
+
+def test_negotiate_never_picks_lossy_on_a_wildcard():
+    assert negotiate("*/*") == "png"
+    assert negotiate("image/*") == "png"
+    assert negotiate("image/*;q=0.8, */*;q=0.5") == "png"
+
+def test_negotiate_named_formats():
+    assert negotiate("image/webp,image/apng,image/*,*/*;q=0.8") == "webp"
+    assert negotiate("image/jpeg") == "jpeg"
+    assert negotiate("IMAGE/JPEG") == "jpeg"
+
+def test_negotiate_quality_values():
+    assert negotiate("image/webp;q=0.5, image/png") == "png"
+    assert negotiate("image/jpeg;q=0.9, image/png;q=0.8") == "jpeg"
+    assert negotiate("image/webp;q=0") == "png"
+    assert negotiate("image/webp;q=bogus") == "webp"
+
+def test_negotiate_ties_prefer_webp_then_png():
+    assert negotiate("image/jpeg, image/png, image/webp") == "webp"
+    assert negotiate("image/jpeg, image/png") == "png"
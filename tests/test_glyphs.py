@@ -0,0 +1,29 @@
+from glyphs import graphemes
+
+
+def test_combining_marks_stay_with_their_base():
+    assert graphemes(u"e\u0301x") == [u"e\u0301", u"x"]
+    assert graphemes(u"a\u0323\u0308b") == [u"a\u0323\u0308", u"b"]
+
+def test_surrogate_pairs_are_one_character():
+    assert graphemes(u"a\U0001F600b") == [u"a", u"\U0001F600", u"b"]
+    # Even spelled out as UTF-16 on a wide build
+    assert len(graphemes(u"\ud83d\ude00")) == 1
+
+def test_emoji_sequences_stay_together():
+    # ZWJ sequence, skin tone, variation selector
+    assert graphemes(u"\U0001F469\u200d\U0001F4BBx") \
+        == [u"\U0001F469\u200d\U0001F4BB", u"x"]
+    assert graphemes(u"\U0001F44D\U0001F3FD") == [u"\U0001F44D\U0001F3FD"]
+    assert graphemes(u"\u2764\ufe0f") == [u"\u2764\ufe0f"]
+
+def test_flags_are_pairs_of_regional_indicators():
+    assert graphemes(u"\U0001F1EB\U0001F1EE\U0001F1F8\U0001F1EA") \
+        == [u"\U0001F1EB\U0001F1EE", u"\U0001F1F8\U0001F1EA"]
+
+def test_conjoining_hangul_jamo_make_one_syllable():
+    assert graphemes(u"\u1100\u1161\u11a8\u1100\u1161") \
+        == [u"\u1100\u1161\u11a8", u"\u1100\u1161"]
+    # Precomposed syllables, on their own or with a trailing jamo
+    assert graphemes(u"\uac00\uac00\u11a8\uac01") \
+        == [u"\uac00", u"\uac00\u11a8", u"\uac01"]
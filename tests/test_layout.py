@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from random import Random
+
+import layout
+
+
+SEP = 6
+
+
+def _measurer(widths, sep=SEP, unrenderable=(), probes=None):
+    """`measure` of texts made of the words in `widths`, each as wide as
+    given, joined by `sep` pixels. Texts in `unrenderable` can't be
+    rendered."""
+    def measure(texts):
+        if probes is not None:
+            probes.append(list(texts))
+        results = []
+        for text in texts:
+            if text in unrenderable:
+                results.append(None)
+                continue
+            words = text.split(" ") if sep else list(text)
+            width = sum(widths[w] for w in words) + sep * (len(words) - 1)
+            results.append(("img:%s" % text, width))
+        return results
+    return measure
+
+def _brute_force(words, widths, max_width, sep=SEP):
+    fits = 0
+    for n in range(1, len(words) + 1):
+        if sum(widths[w] for w in words[:n]) + sep * (n - 1) <= max_width:
+            fits = n
+    return fits
+
+
+def test_fit_words_matches_brute_force():
+    rnd = Random(1)
+    for _i in range(500):
+        words = ["w%d" % n for n in range(rnd.randint(1, 30))]
+        widths = dict((w, rnd.randint(5, 120)) for w in words)
+        max_width = rnd.randint(10, 600)
+        expected = _brute_force(words, widths, max_width)
+
+        # A prediction that's off by up to a third either way
+        skew = rnd.uniform(.67, 1.5)
+        predict = lambda text: sum(widths[w] for w in text.split(" ")) * skew
+        for fanout in (1, 2, 4):
+            for p in (None, predict):
+                count, img, _rounds = layout.fit_words(
+                    words, max_width, _measurer(widths), p, fanout)
+                assert count == expected, (words, widths, max_width, fanout)
+                if count:
+                    assert img == "img:%s" % " ".join(words[:count])
+                else:
+                    assert img is None
+
+def test_fit_words_unrenderable_counts_as_too_wide():
+    words = ["a", "b", "c", "d"]
+    widths = dict.fromkeys(words, 10)
+    count, img, _rounds = layout.fit_words(
+        words, 1000, _measurer(widths, unrenderable=["a b c d", "a b c"]))
+    assert (count, img) == (2, "img:a b")
+
+def test_fit_words_confirms_a_good_prediction_in_two_rounds():
+    words = ["w%d" % n for n in range(20)]
+    widths = dict.fromkeys(words, 20)
+    predict = lambda text: len(text.split(" ")) * 20 + (len(text.split(" ")) - 1) * SEP
+    probes = []
+    count, _img, rounds = layout.fit_words(
+        words, 200, _measurer(widths, probes=probes), predict, 1)
+    assert count == _brute_force(words, widths, 200) == 7
+    assert rounds == 2
+    assert [len(p) for p in probes] == [1, 1]
+
+def test_fit_words_probes_at_most_fanout_at_once():
+    rnd = Random(2)
+    words = ["w%d" % n for n in range(40)]
+    widths = dict((w, rnd.randint(5, 60)) for w in words)
+    for fanout in (1, 3, 5):
+        probes = []
+        layout.fit_words(words, 500, _measurer(widths, probes=probes),
+                         None, fanout)
+        assert all(len(p) <= max(fanout, 1) for p in probes)
+
+def test_fit_chars_matches_brute_force():
+    rnd = Random(3)
+    for _i in range(200):
+        clusters = [unichr(0x4e00 + n) for n in range(rnd.randint(1, 40))]
+        widths = dict((c, rnd.randint(8, 30)) for c in clusters)
+        max_width = rnd.randint(5, 500)
+        for fanout in (1, 4):
+            count, _img, _rounds = layout.fit_chars(
+                clusters, max_width, _measurer(widths, sep=0), None, fanout)
+            assert count == _brute_force(clusters, widths, max_width, sep=0)
+
+def test_predicted_break():
+    words = ["aa", "bb", "cc", "dd"]
+    predict = lambda text: len(text) * 10
+    assert layout.predicted_break(words, 70, predict) == 2
+    assert layout.predicted_break(words, 1000, predict) == 4
+    # At least one, even if nothing fits
+    assert layout.predicted_break(words, 5, predict) == 1
+    assert layout.predicted_break(words, 40, predict, sep=u"") == 2
@@ -0,0 +1,17 @@
+from ratelimit import endpoint
+
+
+def test_endpoint_of_lookup_and_show():
+    assert endpoint("https://api.twitter.com/1.1/statuses/lookup.json"
+                    "?id=1,2,3") == "statuses/lookup"
+    assert endpoint("https://api.twitter.com/1.1/statuses/show.json"
+                    "?id=123") == "statuses/show"
+
+def test_endpoint_leaves_out_ids_in_the_path():
+    assert endpoint("https://api.twitter.com/1.1/statuses/show/123.json") \
+        == "statuses/show"
+    assert endpoint("https://api.twitter.com/1.1/statuses/retweets/123.json") \
+        == "statuses/retweets"
+
+def test_endpoint_without_a_resource():
+    assert endpoint("https://api.twitter.com/") == ""
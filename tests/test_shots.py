@@ -0,0 +1,8 @@
+import shots
+
+
+def test_clamp_raises_widths_to_the_minimum():
+    assert shots.clamp(None) is None
+    assert shots.clamp(0) == shots.MIN_WIDTH
+    assert shots.clamp(shots.MIN_WIDTH - 1) == shots.MIN_WIDTH
+    assert shots.clamp(shots.MIN_WIDTH + 1) == shots.MIN_WIDTH + 1
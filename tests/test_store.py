@@ -0,0 +1,98 @@
+from google.appengine.api import memcache
+
+import store
+from store import ChunkedStore, Manifest
+
+
+class DictFallback(object):
+    name = "dict"
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, time):
+        self.values[key] = value
+
+    def get(self, key):
+        return self.values.get(key)
+
+
+def setup_function(_function):
+    memcache.flush_all()
+
+
+def test_small_values_are_stored_as_they_are():
+    chunked = ChunkedStore(chunk_size=10)
+    assert chunked.set_multi({"k": ("0123456789", 1)}) == []
+    assert memcache.get("k") == ("0123456789", 1)
+    assert chunked.get("k") == ("0123456789", 1)
+    assert chunked.chunked == 0
+
+def test_large_values_are_chunked_under_a_manifest():
+    chunked = ChunkedStore(chunk_size=10)
+    data = "".join(chr(65 + n % 26) for n in range(25))
+    assert chunked.set_multi({"k": (data, "etag", 7)}) == []
+    manifest = memcache.get("k")
+    assert isinstance(manifest, Manifest)
+    assert (manifest.chunks, manifest.size, manifest.rest) == (3, 25, ("etag", 7))
+    assert [memcache.get(k) for k in ("k#0", "k#1", "k#2")] \
+        == [data[:10], data[10:20], data[20:]]
+    assert chunked.get("k") == (data, "etag", 7)
+    assert chunked.chunked == 1
+
+def test_lost_chunk_is_read_from_the_fallback():
+    fallback = DictFallback()
+    chunked = ChunkedStore(fallback, chunk_size=10)
+    data = "x" * 10 + "y" * 10 + "z" * 5
+    chunked.set_multi({"k": (data, 1)})
+    # Chunked values are kept in the fallback too
+    assert fallback.values == {"k": (data, 1)}
+    memcache.delete("k#1")
+    assert chunked.get("k") == (data, 1)
+    assert (chunked.broken, chunked.fallback_hits) == (1, 1)
+
+def test_lost_or_corrupt_chunk_without_fallback():
+    chunked = ChunkedStore(chunk_size=10)
+    chunked.set_multi({"k": ("x" * 25, 1), "j": ("y" * 25, 1)})
+    memcache.delete("k#2")
+    memcache.set("j#0", "z" * 10)
+    assert chunked.get("k") is None
+    assert chunked.get("j") is None
+    assert chunked.broken == 2
+
+def test_values_memcache_refuses_go_to_the_fallback():
+    fallback = DictFallback()
+    chunked = ChunkedStore(fallback, chunk_size=4 * memcache.MAX_VALUE_SIZE)
+    too_large = "x" * (memcache.MAX_VALUE_SIZE + 1)
+    assert chunked.set_multi({"big": (too_large,)}) == []
+    assert chunked.get("big") == (too_large,)
+    assert chunked.fallback_hits == 1
+
+def test_values_up_to_a_chunk_fit_memcache():
+    chunked = ChunkedStore()
+    data = "x" * store.CHUNK_SIZE
+    assert chunked.set_multi({"k": (data, "0" * 40, 1)}) == []
+    assert memcache.get("k") == (data, "0" * 40, 1)
+
+def test_values_memcache_refuses_are_failed_keys():
+    chunked = ChunkedStore(chunk_size=4 * memcache.MAX_VALUE_SIZE)
+    too_large = "x" * (memcache.MAX_VALUE_SIZE + 1)
+    assert chunked.set_multi({"big": (too_large,), "small": ("y",)}) == ["big"]
+    assert chunked.get("small") == ("y",)
+
+def test_fallback_by_name():
+    assert store.fallback("disk").name == "disk"
+    assert store.fallback("") is None
+
+def test_disk_fallback_purges_expired_values():
+    import shutil, tempfile
+    path = tempfile.mkdtemp()
+    try:
+        disk = store.DiskFallback(path)
+        disk.set("old", ("x",), -1)
+        disk.set("new", ("y",), 60)
+        assert disk.purge() == 1
+        assert disk.get("old") is None
+        assert disk.get("new") == ("y",)
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,132 @@
+"""Cache of parsed tweets, fed by batched statuses/lookup calls.
+
+Only the fields needed for rendering are kept. Concurrent misses on an
+instance are collected for a moment and fetched together, up to 100 tweets
+per API call: the Twitter rate limit, not CPU, caps our throughput.
+"""
+
+import logging
+from threading import Event, Lock
+
+from google.appengine.api import memcache
+
+import ratelimit
+import settings
+import twitter
+
+
+KEY = "tweet:%d"
+
+# Fields read by the renderer
+FIELDS = ('id', 'text', 'created_at', 'source', 'in_reply_to_screen_name')
+USER_FIELDS = ('screen_name', 'name', 'profile_image_url',
+               'profile_use_background_image', 'profile_background_image_url',
+               'profile_background_color')
+PLACE_FIELDS = ('full_name',)
+# Entities drawn in colour, kept as `(kind, start, end)`
+ENTITY_KINDS = ('urls', 'media', 'user_mentions', 'hashtags', 'symbols')
+
+
+def compact(tweet):
+    """The tweet trimmed down to the fields used for rendering."""
+    def _pick(obj, fields):
+        return dict((f, obj[f]) for f in fields if obj.get(f) is not None)
+
+    record = _pick(tweet, FIELDS)
+    record['user'] = _pick(tweet.get('user') or {}, USER_FIELDS)
+    if tweet.get('place'):
+        record['place'] = _pick(tweet['place'], PLACE_FIELDS)
+    entities = tweet.get('entities') or {}
+    record['entities'] = [(kind,) + tuple(entity['indices'])
+                          for kind in ENTITY_KINDS
+                          for entity in entities.get(kind) or ()]
+    return record
+
+
+class _Batch(object):
+    def __init__(self):
+        self.ids = set()
+        self.priority = ratelimit.BACKGROUND
+        self.full, self.done = Event(), Event()
+        self.tweets, self.error = {}, None
+
+
+class LookupBatcher(object):
+    """Groups concurrent lookups into batches. The first caller of a batch
+    waits `window` seconds (or until it's full) for others to join, then
+    fetches them all with `fetch(ids)`."""
+
+    def __init__(self, fetch, window, max_size=twitter.LOOKUP_MAX):
+        self.fetch, self.window, self.max_size = fetch, window, max_size
+        self._lock = Lock()
+        self._open = None
+        self.batches = self.lookups = 0
+
+    def get(self, tweet_id, timeout=30):
+        with self._lock:
+            batch, leader = self._open, False
+            if batch is None:
+                batch, leader = _Batch(), True
+                self._open = batch
+            batch.ids.add(tweet_id)
+            # A batch is as urgent as its most urgent lookup
+            batch.priority = min(batch.priority, ratelimit.current())
+            self.lookups += 1
+            if len(batch.ids) >= self.max_size:
+                self._open = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._open is batch:
+                    self._open = None
+                self.batches += 1
+            try:
+                logging.debug("Looking up %d tweets" % len(batch.ids))
+                with ratelimit.priority(batch.priority):
+                    batch.tweets = self.fetch(sorted(batch.ids))
+            except Exception, e:
+                batch.error = e
+            batch.done.set()
+        elif not batch.done.wait(timeout):
+            raise RuntimeError("Timed out waiting for tweet lookup")
+
+        if batch.error:
+            raise batch.error
+        return batch.tweets.get(tweet_id)
+
+    def stats(self):
+        return {'lookups': self.lookups, 'batches': self.batches}
+
+
+BATCHER = LookupBatcher(twitter.lookup, settings.TWEET_LOOKUP_WINDOW)
+
+
+def get(tweet_id):
+    """The compact record of a tweet, or None if it doesn't exist (or isn't
+    visible). Raises `twitter.TwitterAPIError` if the API fails."""
+    tweet = memcache.get(KEY % tweet_id)
+    if tweet is None:
+        tweet = BATCHER.get(tweet_id)
+        if tweet is None:
+            return None
+        tweet = compact(tweet)
+        memcache.set(KEY % tweet_id, tweet, time=settings.TWEET_TTL)
+    return tweet
+
+def get_multi(tweet_ids):
+    """Compact records of many tweets, as a dict by id; tweets that don't
+    exist are left out. Misses are looked up LOOKUP_MAX at a time."""
+    cached = memcache.get_multi([KEY % i for i in tweet_ids])
+    tweets = dict((i, cached[KEY % i]) for i in tweet_ids if KEY % i in cached)
+    missing = [i for i in tweet_ids if i not in tweets]
+    for start in range(0, len(missing), twitter.LOOKUP_MAX):
+        found = dict((i, compact(tweet))
+                     for i, tweet in twitter.lookup(
+                         missing[start:start + twitter.LOOKUP_MAX]).items()
+                     if tweet)
+        memcache.set_multi(dict((KEY % i, tweet) for i, tweet in found.items()),
+                           time=settings.TWEET_TTL)
+        tweets.update(found)
+    return tweets
@@ -0,0 +1,219 @@
+"""Twitter API access with the app's own credentials.
+
+Requests go through `CLIENT`, made once per instance: the HMAC key is
+derived and the constant OAuth parameters encoded up front, and each
+request only signs its own parameters, into an Authorization header.
+Requests go over urlfetch, or with `settings.TWITTER_TRANSPORT` "pooled"
+over keep-alive connections where the runtime allows outbound sockets.
+They're made within the rate limits tracked by `ratelimit`.
+"""
+
+from base64 import b64encode
+from hashlib import sha1
+import hmac
+import httplib
+import json
+import logging
+from random import getrandbits
+import socket
+from threading import Lock
+import time
+from urllib import quote
+import urlparse
+
+from google.appengine.api import urlfetch
+
+import metrics
+import ratelimit
+import secrets
+import settings
+
+
+API = "https://api.twitter.com/1.1"
+
+# statuses/lookup takes at most this many ids per call
+LOOKUP_MAX = 100
+
+DEADLINE = 10
+
+
+class TwitterAPIError(Exception):
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.content = {}
+        try:
+            self.content = json.loads(response.content)
+        except Exception, e:
+            logging.exception(e)
+        super(TwitterAPIError, self).__init__(
+            "Twitter API error %d: %r" % (self.status_code, self.content))
+
+
+def _encode(value):
+    """Percent-encoded as OAuth signs it (RFC 5849 3.6)."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return quote(str(value), "~")
+
+
+def fetch(url, headers):
+    """GET over urlfetch."""
+    return urlfetch.fetch(url, headers=headers, deadline=DEADLINE)
+
+
+class Response(object):
+    """What a pooled request returns, like a urlfetch response."""
+
+    def __init__(self, status_code, content, headers):
+        self.status_code, self.content, self.headers = \
+            status_code, content, headers
+
+
+class ConnectionPool(object):
+    """GETs over kept-alive HTTP(S) connections, at most `size` idle ones
+    per host. Thread-safe: a connection is used by one request at a time."""
+
+    def __init__(self, size=4):
+        self.size = size
+        self._idle = {}
+        self._lock = Lock()
+        self.opened = self.reused = 0
+
+    def _connection(self, scheme, host):
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            if idle:
+                self.reused += 1
+                return idle.pop()
+            self.opened += 1
+        connection = (httplib.HTTPSConnection if scheme == "https"
+                      else httplib.HTTPConnection)
+        return connection(host, timeout=DEADLINE)
+
+    def _release(self, scheme, host, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def __call__(self, url, headers):
+        parts = urlparse.urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        for attempt in (0, 1):
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request("GET", path, headers=headers)
+                rs = connection.getresponse()
+                content = rs.read()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                # An idle connection may have been closed by the server
+                if attempt == 0 and not isinstance(e, socket.timeout):
+                    continue
+                raise urlfetch.DownloadError(str(e))
+            if rs.will_close:
+                connection.close()
+            else:
+                self._release(parts.scheme, parts.netloc, connection)
+            return Response(rs.status, content, rs.msg)
+
+    def close(self):
+        """Closes the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def stats(self):
+        with self._lock:
+            return {'opened': self.opened, 'reused': self.reused,
+                    'idle': sum(len(idle) for idle in self._idle.values())}
+
+
+class Client(object):
+    """Signs and sends GET requests with one set of credentials.
+    Thread-safe; the signing key is only ever copied."""
+
+    def __init__(self, consumer_key, consumer_secret, token, token_secret,
+                 transport=fetch):
+        self._mac = hmac.new("%s&%s" % (_encode(consumer_secret),
+                                        _encode(token_secret)), digestmod=sha1)
+        self._oauth = [("oauth_consumer_key", _encode(consumer_key)),
+                       ("oauth_signature_method", "HMAC-SHA1"),
+                       ("oauth_token", _encode(token)),
+                       ("oauth_version", "1.0")]
+        self.transport = transport
+
+    def authorization(self, url, params):
+        """Authorization header value for a GET of `url` (without a query)
+        with the already encoded `params`, a list of pairs."""
+        oauth = self._oauth + [("oauth_nonce", str(getrandbits(64))),
+                               ("oauth_timestamp", str(int(time.time())))]
+        message = "GET&%s&%s" % (
+            _encode(url),
+            _encode("&".join("%s=%s" % p for p in sorted(oauth + params))))
+        mac = self._mac.copy()
+        mac.update(message)
+        oauth.append(("oauth_signature", _encode(b64encode(mac.digest()))))
+        return "OAuth " + ", ".join('%s="%s"' % p for p in oauth)
+
+    def request(self, url, params=None):
+        """Signed GET of `url` with query `params`, which can also be in
+        the URL."""
+        parts = urlparse.urlsplit(url)
+        url = urlparse.urlunsplit(parts[:3] + ("", ""))
+        pairs = [(_encode(k), _encode(v))
+                 for k, v in urlparse.parse_qsl(parts.query, True)]
+        pairs += [(_encode(k), _encode(v)) for k, v in (params or {}).items()]
+        headers = {'Authorization': self.authorization(url, pairs)}
+        if pairs:
+            url += "?" + "&".join("%s=%s" % p for p in pairs)
+        return self.transport(url, headers)
+
+    def stats(self):
+        stats = getattr(self.transport, 'stats', None)
+        return stats() if stats else {}
+
+
+def transport(name=None):
+    """The transport named `name`, default `settings.TWITTER_TRANSPORT`."""
+    if (name or settings.TWITTER_TRANSPORT) == "pooled":
+        return ConnectionPool(settings.TWITTER_POOL_SIZE)
+    return fetch
+
+CLIENT = Client(secrets.CONSUMER_KEY, secrets.CONSUMER_SECRET,
+                secrets.CLIENT_TOKEN, secrets.CLIENT_SECRET, transport())
+
+
+def request(url, params=None):
+    """Signed GET request with `CLIENT`, within the rate limits. Raises
+    `ratelimit.RateLimited` when out of calls, or on a 429."""
+    endpoint = ratelimit.endpoint(url)
+    ratelimit.LIMITS.acquire(endpoint)
+    metrics.count("twitter_calls")
+    rs = CLIENT.request(url, params)
+    ratelimit.LIMITS.update(endpoint, rs)
+    return rs
+
+def _json(rs):
+    if rs.status_code != 200:
+        raise TwitterAPIError(rs)
+    # Twitter API encodes utf-8
+    assert 'utf-8' in rs.headers['Content-Type']
+    return json.loads(rs.content)
+
+def show(tweet_id):
+    return _json(request("%s/statuses/show/%d.json" % (API, tweet_id)))
+
+def lookup(tweet_ids):
+    """Tweets by id, with one statuses/lookup call of up to LOOKUP_MAX ids.
+    Returns a dict of id to tweet, None for the ones that don't exist or
+    aren't visible."""
+    assert len(tweet_ids) <= LOOKUP_MAX
+    rs = _json(request("%s/statuses/lookup.json" % API,
+                       {'map': "true", 'include_entities': "true",
+                        'id': ",".join(str(i) for i in tweet_ids)}))
+    return dict((int(tweet_id), tweet) for tweet_id, tweet in rs['id'].items())
@@ -0,0 +1,195 @@
+"""Text rendering backends.
+
+`ChartText` renders with the Chart API's outlined text icons (see
+`charts`). `LocalText` draws the same thing in-process with PIL and a
+TrueType font, `settings.TEXT_FONT`: the text in its colour on white, with
+a one pixel outline. A font rarely covers every script, so texts with
+characters outside `settings.TEXT_FONT_SCRIPTS` (glyph buckets, see
+`glyphs.bucket`) go to the fallback backend, the Chart API by default.
+
+Texts drawn over each other have to come from the same backend, or the
+fonts and widths won't line up: the coloured segments of a line of tweet
+text are drawn by the backend that drew the line, the first of `chain()`
+that covers it.
+
+Either way, `text_imgs` returns `(results, fetched)` like
+`charts.text_imgs`: a `charts.Fragment` or `ChartAPIException` per text,
+and the number of remote requests made. `text_widths` returns the same
+with widths in place of fragments; locally that's measured without drawing
+anything, the Chart API has to render the text (and the fragment is kept
+for drawing it after all).
+"""
+
+from cStringIO import StringIO
+import logging
+import os
+
+from cache import LRUCache
+import charts
+from charts import ChartAPIException, Fragment
+import glyphs
+import metrics
+import settings
+
+try:
+    from PIL import Image, ImageDraw, ImageFilter, ImageFont
+except ImportError:
+    Image = ImageDraw = ImageFilter = ImageFont = None
+
+
+OUTLINE = 1
+
+
+def _rgb(color):
+    return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+
+
+class ChartText(object):
+    name = "chart"
+
+    def covers(self, text):
+        return True
+
+    def text_imgs(self, texts, color="000000", size=23, outline="f7f7f7"):
+        return charts.text_imgs(texts, color, size, outline)
+
+    def text_widths(self, texts, size=23):
+        results, fetched = charts.text_imgs(texts, size=size)
+        return [result if isinstance(result, ChartAPIException)
+                else result.width for result in results], fetched
+
+
+class LocalText(object):
+    """Draws text with the TrueType font at `path`, which covers the glyph
+    buckets `scripts`."""
+
+    name = "local"
+
+    def __init__(self, path, scripts):
+        # Zero-width code points (bucket None) go with anything
+        self.path, self.scripts = path, frozenset(scripts) | frozenset([None])
+        self._fonts = {}
+        self.fragments = LRUCache(max_items=2000, max_bytes=4 * 2**20,
+                                  sizeof=lambda fragment: len(fragment.img))
+
+    def _font(self, size):
+        font = self._fonts.get(size)
+        if font is None:
+            font = self._fonts[size] = ImageFont.truetype(self.path, size)
+        return font
+
+    def covers(self, text):
+        return all(glyphs.bucket(cp) in self.scripts
+                   for cp in glyphs.codepoints(text))
+
+    def measure(self, text, size=23):
+        """Width of `text` as it would be drawn, without drawing it."""
+        return self._font(size).getsize(text)[0] + 2 * OUTLINE
+
+    def render(self, text, color="000000", size=23, outline="f7f7f7"):
+        """A `Fragment` of `text` drawn like the Chart API would."""
+        key = (text, color, size, outline)
+        fragment = self.fragments.get(key)
+        if fragment is not None:
+            return fragment
+        font = self._font(size)
+        ascent, descent = font.getmetrics()
+        width = font.getsize(text)[0] + 2 * OUTLINE
+        height = ascent + descent + 2 * OUTLINE
+
+        # Glyphs are drawn once, as a mask; the outline is the mask grown
+        mask = Image.new("L", (max(width, 1), height), 0)
+        ImageDraw.Draw(mask).text((OUTLINE, OUTLINE), text, font=font, fill=255)
+        img = Image.new("RGB", mask.size, (255, 255, 255))
+        img.paste(_rgb(outline), None,
+                  mask.filter(ImageFilter.MaxFilter(2 * OUTLINE + 1)))
+        img.paste(_rgb(color), None, mask)
+        out = StringIO()
+        img.save(out, "PNG")
+        fragment = Fragment(out.getvalue(), width)
+        self.fragments.set(key, fragment)
+        metrics.count("local_texts")
+        return fragment
+
+    def text_imgs(self, texts, color="000000", size=23, outline="f7f7f7"):
+        return [self.render(text, color, size, outline) for text in texts], 0
+
+    def text_widths(self, texts, size=23):
+        return [self.measure(text, size) for text in texts], 0
+
+
+class FallbackText(object):
+    """Renders what `primary` covers with it, the rest with `fallback`."""
+
+    def __init__(self, primary, fallback):
+        self.primary, self.fallback = primary, fallback
+        self.name = primary.name
+        self.backends = (primary, fallback)
+
+    def covers(self, text):
+        return True
+
+    def _split(self, call, texts):
+        """`call(backend, texts)` with the texts `primary` covers and with
+        the rest, the results merged."""
+        local = [self.primary.covers(text) for text in texts]
+        results = dict(zip(
+            [t for t, l in zip(texts, local) if l],
+            call(self.primary, [t for t, l in zip(texts, local) if l])[0]))
+        remote = [t for t, l in zip(texts, local) if not l]
+        fetched = 0
+        if remote:
+            remote_results, fetched = call(self.fallback, remote)
+            results.update(zip(remote, remote_results))
+        return [results[text] for text in texts], fetched
+
+    def text_imgs(self, texts, color="000000", size=23, outline="f7f7f7"):
+        return self._split(lambda backend, texts: backend.text_imgs(
+            texts, color, size, outline), texts)
+
+    def text_widths(self, texts, size=23):
+        return self._split(lambda backend, texts: backend.text_widths(
+            texts, size), texts)
+
+
+def get(name=None, fallback=None):
+    """The text backend named `name` (default `settings.TEXT_BACKEND`),
+    falling back to the one named `fallback` (default
+    `settings.TEXT_FALLBACK`) for texts it can't render."""
+    name = name or settings.TEXT_BACKEND
+    fallback = fallback or settings.TEXT_FALLBACK
+    if name == "local":
+        try:
+            if ImageFont is None:
+                raise IOError("PIL not available")
+            if not os.path.exists(settings.TEXT_FONT):
+                raise IOError("No font at %s" % settings.TEXT_FONT)
+            backend = LocalText(settings.TEXT_FONT, settings.TEXT_FONT_SCRIPTS)
+            backend.measure(u"x")
+        except Exception, e:
+            logging.warning("Can't render text locally, using the Chart API: %s"
+                            % e)
+            return ChartText()
+        if fallback == "chart":
+            return FallbackText(backend, ChartText())
+        return backend
+    return ChartText()
+
+BACKEND = get()
+
+
+def chain():
+    """The backends of `BACKEND` in order of preference."""
+    return getattr(BACKEND, 'backends', (BACKEND,))
+
+def text_imgs(texts, color="000000", size=23, outline="f7f7f7"):
+    """Renders several texts with `BACKEND`."""
+    return BACKEND.text_imgs(texts, color, size, outline)
+
+def text_img(text, color="000000", size=23, outline="f7f7f7"):
+    """A `Fragment` of `text` by `BACKEND`; raises the `ChartAPIException`
+    if the Chart API fails."""
+    (result,), _fetched = text_imgs([text], color, size, outline)
+    if isinstance(result, ChartAPIException):
+        raise result
+    return result